@@ -0,0 +1,217 @@
+"""Headless batch counting of saved images (no Qt required).
+
+Usage:
+    python src/batchCount.py /media/pi/USB -o counts.csv
+    python src/batchCount.py /media/pi/USB -o counts.jsonl -j 8
+    python src/batchCount.py /media/pi/USB -o counts.csv --paired
+"""
+import os
+# each worker process counts one image at a time, so keep the numerical libraries single threaded
+# to avoid oversubscribing the cores. must be set before numpy/cv2 are imported.
+for _var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_var, "1")
+
+import sys
+import csv
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+
+import constants
+from logger import logger
+from count import getCells, getCellsPaired, countingSettings
+from memoryUsage import peakRSS
+from imageWriter import readImage, EXTENSIONS, ARCHIVE_SEPARATOR
+from runArchive import RunArchive
+from profiling import profiler
+import peakMarkers
+from resultCache import cached
+
+
+IMAGE_SUFFIXES = tuple(f"_{mode}{ending}" for mode in ["color", "UV"] for ending in EXTENSIONS.values())
+
+
+def findImages(directory, suffixes = IMAGE_SUFFIXES):
+    """Return sorted list of all image files in directory (recursive) ending with one of suffixes.
+    Frames of run archives (.h5) are listed as <archive file>:<frame name>.
+    :param str directory: root directory
+    :param tuple suffixes: file name endings to match"""
+    files = []
+    for root, _, fileNames in os.walk(directory):
+        files += [os.path.join(root, fileName) for fileName in fileNames if fileName.endswith(suffixes)]
+        files += [frame for fileName in fileNames if fileName.endswith(EXTENSIONS["hdf5"]) for frame in archiveFrames(os.path.join(root, fileName))]
+    return sorted(files)
+
+
+def archiveFrames(path):
+    """Color and UV frames of run archive as <archive file>:<frame name>. Empty if archive can not be read."""
+    try:
+        with RunArchive(path, "r") as archive:
+            return [path + ARCHIVE_SEPARATOR + name for name in archive.frames() if name.endswith(("_color", "_UV"))]
+    except (ImportError, OSError) as e:
+        logger.warn(f"Skipping run archive {path}: {e}")
+        return []
+
+
+def captureName(path):
+    """Split image file (or run archive frame) name into capture name and mode.
+    :return tuple: path without mode suffix and file ending, mode ("color" or "UV")"""
+    if EXTENSIONS["hdf5"] + ARCHIVE_SEPARATOR not in path:
+        path = os.path.splitext(path)[0]
+    name, mode = path.rsplit("_", 1)
+    return name, mode
+
+
+def pairImages(files):
+    """Pair color and UV image of each capture (<name>_color and <name>_UV, as written by triggerAndSave).
+    :return tuple: list of (color file, UV file), list of files without partner"""
+    captures = {}
+    for path in files:
+        name, mode = captureName(path)
+        captures.setdefault(name, {})[mode] = path
+    pairs   = [(capture["color"], capture["UV"]) for capture in captures.values() if len(capture) == 2]
+    singles = sorted(path for capture in captures.values() if len(capture) != 2 for path in capture.values())
+    return sorted(pairs), singles
+
+
+def loadSettings(path):
+    """Parse settings file to constants.settings (same as util.loadSettings, which needs Qt).
+    :param str path: settings.json"""
+    with open(path) as file:
+        constants.settings = json.load(file)
+
+
+def _initWorker(settings):
+    """Called once in every worker process."""
+    cv2.setNumThreads(1)
+    constants.settings = settings
+    profiler.configure()
+    peakMarkers.warmUp()
+
+
+def countFile(path):
+    """Load image from path and count cells.
+    :param str path: image file as written by MainWindow.saveImage
+    :return dict: file name, number of cells, cell centroids, time needed and peak memory of the counting,
+                  whether the result was taken from the result cache. the worker process counts nothing else meanwhile,
+                  so its peak RSS is the peak of this counting (see memoryUsage)"""
+    image = readImage(path)
+
+    startTime = time.perf_counter()
+    cells, fromCache = cached((image,), countingSettings(), lambda: getCells(image))
+    return {"file": path, "count": len(cells), "cells": cells, "seconds": time.perf_counter() - startTime, "peakRSSMB": peakRSS(),
+            "cached": fromCache}
+
+
+def countPair(path, uvPath):
+    """Load color and UV image of one capture and count cells with getCellsPaired.
+    :return dict: same as countFile with UV file name, number of fluorescent cells and fluorescent flag of every cell"""
+    image   = readImage(path)
+    uvImage = readImage(uvPath)
+
+    startTime = time.perf_counter()
+    (cells, fluorescent), fromCache = cached((image, uvImage), countingSettings(), lambda: getCellsPaired(image, uvImage))
+    return {"file": path, "uvFile": uvPath, "count": len(cells), "fluorescentCount": sum(fluorescent), "cells": cells,
+            "fluorescent": fluorescent, "seconds": time.perf_counter() - startTime, "peakRSSMB": peakRSS(), "cached": fromCache}
+
+
+class ResultWriter():
+    """Write results line by line to csv or jsonl file."""
+    def __init__(self, file, fileFormat, paired = False):
+        """:param bool paired: add columns of countPair to csv"""
+        self.file = file
+        self.fileFormat = fileFormat
+        if paired:
+            self.columns = ["file", "uvFile", "count", "fluorescentCount", "seconds", "peakRSSMB", "cached", "error", "cells"]
+        else:
+            self.columns = ["file", "count", "seconds", "peakRSSMB", "cached", "error", "cells"]
+        if self.fileFormat == "csv":
+            self.csvWriter = csv.writer(self.file)
+            self.csvWriter.writerow(self.columns)
+
+    def write(self, result):
+        if self.fileFormat == "csv":
+            row = {"file"            : result["file"],
+                   "uvFile"          : result.get("uvFile", ""),
+                   "count"           : result.get("count", ""),
+                   "fluorescentCount": result.get("fluorescentCount", ""),
+                   "seconds"         : f"{result['seconds']:.3f}" if "seconds" in result else "",
+                   "peakRSSMB"       : f"{result['peakRSSMB']:.0f}" if "peakRSSMB" in result else "",
+                   "cached"          : result.get("cached", ""),
+                   "error"           : result.get("error", ""),
+                   "cells"           : json.dumps(result.get("cells", []))}
+            self.csvWriter.writerow([row[column] for column in self.columns])
+        else:
+            self.file.write(json.dumps(result) + "\n")
+        self.file.flush()
+
+
+def countDirectory(directory, outFile, fileFormat = "csv", workers = None, paired = False):
+    """Count all images in directory using a process pool and stream results to outFile.
+    :param str directory: directory to search for images
+    :param file outFile: opened text file
+    :param str fileFormat: "csv" or "jsonl"
+    :param int workers: number of processes. default is number of cores
+    :param bool paired: count color and UV image of a capture together (countPair), images without partner alone
+    :return int: number of successfully counted images (pairs count as one)"""
+    files = findImages(directory)
+    jobs = [(countFile, path) for path in files]
+    if paired:
+        pairs, singles = pairImages(files)
+        jobs = [(countPair, *pair) for pair in pairs] + [(countFile, path) for path in singles]
+    workers = workers or os.cpu_count()
+    logger.info(f"Counting {len(jobs)} images{' / pairs' if paired else ''} using {workers} processes")
+
+    writer = ResultWriter(outFile, fileFormat, paired)
+    done = 0
+    startTime = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = workers, initializer = _initWorker, initargs = (constants.settings,)) as executor:
+        futures = {executor.submit(*job): job[1] for job in jobs}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+                done += 1
+                fluorescent = f", {result['fluorescentCount']} fluorescent" if "fluorescentCount" in result else ""
+                fromCache = ", cached" if result["cached"] else ""
+                logger.info(f"{result['file']}: {result['count']} cells{fluorescent} ({result['seconds']:.1f} s{fromCache})")
+            except Exception as e: # pylint: disable=broad-except
+                result = {"file": futures[future], "error": str(e)}
+                logger.warn(f"{futures[future]}: {e}")
+            writer.write(result)
+
+    logger.info(f"Counted {done}/{len(jobs)} images in {time.perf_counter() - startTime:.1f} s")
+    return done
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Count cells in all saved images of a directory.")
+    parser.add_argument("directory", help = "directory containing *_color.tiff / *_UV.tiff (or .png, .npz, .npy) files or run archives (.h5)")
+    parser.add_argument("-o", "--output", default = None, help = "output file (.csv or .jsonl). default: stdout")
+    parser.add_argument("-f", "--format", choices = ["csv", "jsonl"], default = None, help = "output format. default: from file ending, csv otherwise")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "number of worker processes. default: number of cores")
+    parser.add_argument("-s", "--settings", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../resources/settings.json"),
+                        help = "settings file with counting parameters. default: resources/settings.json")
+    parser.add_argument("-p", "--profile", action = "store_true", help = "log time of every counting stage")
+    parser.add_argument("-u", "--paired", action = "store_true", help = "count color and UV image of a capture together, cells are classified as fluorescent")
+    args = parser.parse_args(argv)
+
+    loadSettings(args.settings)
+    if args.profile:
+        constants.settings.setdefault("Profiling", {})["enabled"] = True
+
+    fileFormat = args.format
+    if fileFormat is None:
+        fileFormat = "jsonl" if args.output is not None and args.output.endswith(".jsonl") else "csv"
+
+    if args.output is None:
+        countDirectory(args.directory, sys.stdout, fileFormat, args.jobs, args.paired)
+    else:
+        with open(args.output, "w", newline = "") as outFile:
+            countDirectory(args.directory, outFile, fileFormat, args.jobs, args.paired)
+
+
+if __name__ == '__main__':
+    main()
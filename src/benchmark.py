@@ -0,0 +1,391 @@
+"""Benchmarks for the counting pipeline on synthetic dish images.
+
+Usage:
+    python src/benchmark.py circle
+    python src/benchmark.py save -d /media/pi/USB
+    python src/benchmark.py pipeline -o resources/benchmarkBaseline_$(uname -m).json
+    python src/benchmark.py pipeline --baseline resources/benchmarkBaseline_$(uname -m).json --threshold 0.1
+    python src/benchmark.py backends --tolerance 0.05
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import cv2
+import scipy
+import skimage
+from scipy.spatial import cKDTree
+
+import constants
+import count
+import imageWriter
+
+
+def makeSyntheticDish(size = 3040, numCells = 50, cellRadius = None, seed = 0, spacing = 5):
+    """Generate RGB image of a dish with gaussian blobs as cells.
+    :param int size: image height and width
+    :param int numCells: number of non overlapping cells
+    :param float cellRadius: default scales with size (25 px at 3040 px)
+    :param float spacing: minimal distance of cell centers in cell radii. below about 3 neighbouring cells touch
+    :return tuple: image, dish circle (row, column, radius), cell centers (n, 2) as row, column"""
+    rng = np.random.default_rng(seed)
+    if cellRadius is None:
+        cellRadius = 25 / 3040 * size
+
+    dishCircle = np.array([size / 2 + rng.uniform(-0.02, 0.02) * size,
+                           size / 2 + rng.uniform(-0.02, 0.02) * size,
+                           rng.uniform(1280, 1370) / 3040 * size])
+
+    image = np.full((size, size, 3), 20, dtype = np.float32)
+    center = (int(round(dishCircle[1])), int(round(dishCircle[0])))
+    cv2.circle(image, center, int(round(dishCircle[2])), (60, 60, 60), thickness = -1)
+    cv2.circle(image, center, int(round(dishCircle[2])), (200, 200, 200), thickness = max(2, size // 300))
+
+    cells = []
+    while len(cells) < numCells:
+        r, phi = np.sqrt(rng.uniform()) * (dishCircle[2] - 6 * cellRadius), rng.uniform(0, 2 * np.pi)
+        cell = dishCircle[:2] + r * np.array([np.sin(phi), np.cos(phi)])
+        if all(np.hypot(*(cell - other)) > spacing * cellRadius for other in cells):
+            cells.append(cell)
+
+    sigma = cellRadius / 2
+    halfWidth = int(4 * sigma) + 1
+    for cell in cells:
+        row, col = np.rint(cell).astype(int)
+        rows, cols = np.mgrid[row - halfWidth:row + halfWidth + 1, col - halfWidth:col + halfWidth + 1]
+        blob = 200 * np.exp(-((rows - cell[0])**2 + (cols - cell[1])**2) / (2 * sigma**2))
+        image[rows, cols, 1] += blob
+        image[rows, cols, 2] += blob
+
+    image = cv2.GaussianBlur(image, (0, 0), 1.5)
+    image += rng.normal(0, 2, image.shape).astype(np.float32)
+
+    return np.clip(image, 0, 255).astype(np.uint8), dishCircle, np.array(cells)
+
+
+def _timeit(function, repeats):
+    """:return tuple: result of last call, best time in seconds"""
+    best = np.inf
+    for _ in range(repeats):
+        startTime = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - startTime)
+    return result, best
+
+
+def benchmarkCircleDetection(sizes = (1520, 3040), repeats = 3, seeds = (0, 1, 2)):
+    """Compare "full" and "pyramid" circle detection (settings["Counting"]["circleDetection"]).
+    :return list[dict]: one entry per size, seed and mode"""
+    savedSettings = constants.settings
+    results = []
+    try:
+        for size in sizes:
+            Rmin = 1250 / 3040 * size
+            Rmax = 1400 / 3040 * size
+            reduceFactor, coarseReduceFactor = count.circleReduceFactors((size, size))
+            accumulatorPixels = {
+                "full"   : len(np.arange(Rmin/reduceFactor, Rmax/reduceFactor, dtype = int)) * (size // reduceFactor)**2,
+                "pyramid": len(np.arange(Rmin/coarseReduceFactor, Rmax/coarseReduceFactor + 1, dtype = int)) * (size // coarseReduceFactor)**2,
+            }
+            for seed in seeds:
+                image, dishCircle, _ = makeSyntheticDish(size, numCells = 0, seed = seed)
+                for mode in ["full", "pyramid"]:
+                    constants.settings = {"Counting": {"circleDetection": mode}}
+                    circle, seconds = _timeit(lambda: count.findDishCircle(image, useCache = False), repeats)
+                    results.append({"size": size,
+                                    "seed": seed,
+                                    "mode": mode,
+                                    "seconds": seconds,
+                                    "accumulatorMB": accumulatorPixels[mode] * 8 / 1e6,
+                                    "centerError": float(np.hypot(*(circle[:2] - dishCircle[:2]))),
+                                    "radiusError": float(circle[2] - dishCircle[2])})
+    finally:
+        constants.settings = savedSettings
+    return results
+
+
+SAVE_CODECS = [
+    {"format": "tiff", "tiffCompression": "none"},
+    {"format": "tiff", "tiffCompression": "lzw"},
+    {"format": "tiff", "tiffCompression": "deflate"},
+    {"format": "tiff", "tiffCompression": "zstd"},
+    {"format": "png" , "pngCompression": 0},
+    {"format": "png" , "pngCompression": 1},
+    {"format": "png" , "pngCompression": 3},
+    {"format": "png" , "pngCompression": 6},
+    {"format": "npz"},
+    {"format": "npy"},
+]
+
+
+def benchmarkImage(size = 3040):
+    """constants.TEST_IMAGE_NAME as RGB image if present in working directory, synthetic dish otherwise."""
+    if os.path.isfile(constants.TEST_IMAGE_NAME):
+        return imageWriter.readImage(constants.TEST_IMAGE_NAME)
+    return makeSyntheticDish(size)[0]
+
+
+def benchmarkSave(image = None, directory = None, repeats = 3, codecs = SAVE_CODECS):
+    """Measure encoding time, writing time and file size of every codec.
+    :param np.ndarray image: RGB image. default: benchmarkImage()
+    :param str directory: where files are written (e.g. usb stick). default: temporary directory
+    :return list[dict]: one entry per codec"""
+    if image is None:
+        image = benchmarkImage()
+    results = []
+    with tempfile.TemporaryDirectory(dir = directory) as tempDir:
+        for codec in codecs:
+            result = dict(codec)
+            try:
+                (buffer, ending), encodeSeconds = _timeit(lambda: imageWriter.encodeImage(image, codec), repeats)
+            except IOError as e:
+                result["error"] = str(e)
+                results.append(result)
+                continue
+
+            def write():
+                with open(os.path.join(tempDir, "image" + ending), "wb") as file:
+                    file.write(buffer)
+                    file.flush()
+                    os.fsync(file.fileno())
+            _, writeSeconds = _timeit(write, repeats)
+
+            result.update({"encodeSeconds": encodeSeconds,
+                           "writeSeconds" : writeSeconds,
+                           "MB"           : buffer.nbytes / 1e6,
+                           "ratio"        : image.nbytes / buffer.nbytes,
+                           "imageMBPerSecond": image.nbytes / 1e6 / (encodeSeconds + writeSeconds)})
+            results.append(result)
+    return results
+
+
+PIPELINE_SIZES = (480, 1520, 3040)
+CLUSTERED_CELLS_FACTOR = 8 # clustered dishes have this many times more cells, spaced 2 radii (touching)
+
+
+def pipelineStages(image, params):
+    """Stages of count.getCells with the backend of params, run one after another.
+    :return list: (stage name, function of results of previous stages)"""
+    compact = params["compactDtype"]
+    backend = count.getBackend(params)
+    return [
+        ("circleDownscale"  , lambda r: count.circleImages(image)),
+        ("circleEdges"      , lambda r: count.circleEdges(r["circleDownscale"][1])),
+        ("circleSearch"     , lambda r: count.searchCircle(r["circleDownscale"][1], r["circleEdges"], image.shape, *r["circleDownscale"][2:])),
+        ("circleRefine"     , lambda r: count.upscaleCircle(r["circleDownscale"][0], r["circleSearch"], r["circleDownscale"][2])),
+        ("circleMask"       , lambda r: count.circleMask(image.shape, r["circleRefine"], params["additionalCut"])),
+        ("mixChannels"      , lambda r: count.mixChannels(image, r["circleRefine"], params["additionalCut"], compact, r["circleMask"])),
+        ("threshold"        , lambda r: r["mixChannels"] > params["threshold"]),
+        ("crop"             , lambda r: count.dishBoundingBox(r["mixChannels"], count.cropMargin(params))),
+        ("distanceTransform", lambda r: backend.distanceTransform(r["threshold"][r["crop"]], compact)),
+        ("smoothDistance"   , lambda r: backend.smooth(r["distanceTransform"], params["distanceSigma"], compact)),
+        ("smoothImage"      , lambda r: backend.smooth(r["mixChannels"][r["crop"]], params["imageSigma"], compact)),
+        ("combine"          , lambda r: count.combineSmoothed(r["smoothDistance"], r["smoothImage"], inPlace = True)),
+        ("peakLocalMax"     , lambda r: backend.findMarkers(r["combine"], r["threshold"][r["crop"]], params["minDistance"])),
+        ("watershed"        , lambda r: backend.segment(r["combine"], r["peakLocalMax"], r["threshold"][r["crop"]], inPlace = True)),
+        ("regionStatistics" , lambda r: count.filterRegions(r["watershed"], params)),
+    ]
+
+
+def timeStages(image, params, repeats):
+    """Time every stage of the pipeline (best of repeats per stage).
+    :return tuple: dict stage: seconds, cells as (x, y)"""
+    best = {}
+    for _ in range(repeats):
+        results = {}
+        for name, function in pipelineStages(image, params):
+            startTime = time.perf_counter()
+            results[name] = function(results)
+            best[name] = min(best.get(name, np.inf), time.perf_counter() - startTime)
+    crop = results["crop"]
+    cells = [(int(col + crop[1].start), int(row + crop[0].start)) for row, col in results["regionStatistics"]]
+    return best, cells
+
+
+def countAccuracy(cells, trueCells, tolerance):
+    """Match found cells to ground truth.
+    :param list cells: found cells as (x, y)
+    :param np.ndarray trueCells: (n, 2) as row, column
+    :param float tolerance: maximal distance of a match in pixels
+    :return dict: true count, found count, matched, precision, recall"""
+    found = np.array([(y, x) for x, y in cells], dtype = float).reshape(-1, 2)
+    matched = 0
+    if len(found) and len(trueCells):
+        # each true cell is matched at most once, to the closest found cell
+        distance, index = cKDTree(found).query(trueCells, distance_upper_bound = tolerance)
+        matched = len(np.unique(index[np.isfinite(distance)]))
+    return {"trueCount": len(trueCells),
+            "count"    : len(found),
+            "matched"  : matched,
+            "precision": matched / len(found) if len(found) else 1.0,
+            "recall"   : matched / len(trueCells) if len(trueCells) else 1.0}
+
+
+def pipelineImages(sizes = PIPELINE_SIZES, seeds = (0,), numCells = 50, clustered = False):
+    """Synthetic dishes of all sizes and constants.TEST_IMAGE_NAME (without ground truth) if present in the working directory.
+    :param bool clustered: add dishes with CLUSTERED_CELLS_FACTOR * numCells touching cells
+    :return list: (key dict with image, size and seed, RGB image, true cells or None, cell radius or None)"""
+    images = []
+    for size in sizes:
+        for seed in seeds:
+            image, _, trueCells = makeSyntheticDish(size, numCells = numCells, seed = seed)
+            images.append(({"image": "synthetic", "size": size, "seed": seed}, image, trueCells, 25 / 3040 * size))
+            if clustered:
+                image, _, trueCells = makeSyntheticDish(size, numCells = CLUSTERED_CELLS_FACTOR * numCells, seed = seed, spacing = 2)
+                images.append(({"image": "clustered", "size": size, "seed": seed}, image, trueCells, 25 / 3040 * size))
+    if os.path.isfile(constants.TEST_IMAGE_NAME):
+        image = imageWriter.readImage(constants.TEST_IMAGE_NAME)
+        images.append(({"image": constants.TEST_IMAGE_NAME, "size": image.shape[0], "seed": None}, image, None, None))
+    return images
+
+
+def environment():
+    """:return dict: versions of python and libraries used for counting"""
+    return {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "numpy": np.__version__, "scipy": scipy.__version__, "skimage": skimage.__version__, "cv2": cv2.__version__}
+
+
+def benchmarkPipeline(sizes = PIPELINE_SIZES, repeats = 3, seeds = (0,), numCells = 50):
+    """Per stage timings and count accuracy of the counting pipeline on pipelineImages().
+    Counting parameters are countingSettings() scaled to the image size (they are tuned for 3040 px).
+    :return dict: report with environment and one result per image"""
+    results = []
+    for key, image, trueCells, cellRadius in pipelineImages(sizes, seeds, numCells):
+        params = count.scaleParams(count.countingSettings(), constants.CAMERA_RESOLUTION[0] / image.shape[0])
+        stages, cells = timeStages(image, params, repeats)
+        result = {**key, "stages": stages, "stagesTotal": sum(stages.values())}
+
+        def getCells():
+            count.circleCache.clear()
+            return count.getCells(image, params)
+        _, result["getCells"] = _timeit(getCells, repeats)
+
+        if trueCells is not None:
+            result.update(countAccuracy(cells, trueCells, tolerance = cellRadius))
+        else:
+            result["count"] = len(cells)
+        results.append(result)
+
+    return {"environment": environment(),
+            "settings": count.countingSettings(),
+            "repeats": repeats,
+            "results": results}
+
+
+def benchmarkBackends(sizes = PIPELINE_SIZES, repeats = 3, seeds = (0,), numCells = 50, tolerance = 0.05, reference = "skimage"):
+    """Speed of getCells with every backend in count.BACKENDS and agreement of its counts with the reference backend
+    on pipelineImages(), including clustered dishes, where segmentation differences show up.
+    :param float tolerance: maximal relative difference of a count to the reference count
+    :return dict: report with one result per image and backend, results outside of tolerance are listed in "disagreements" """
+    results = []
+    for key, image, trueCells, cellRadius in pipelineImages(sizes, seeds, numCells, clustered = True):
+        params = count.scaleParams(count.countingSettings(), constants.CAMERA_RESOLUTION[0] / image.shape[0])
+        backendCells = {}
+        for name in [reference] + [name for name in count.BACKENDS if name != reference]:
+            def getCells():
+                count.circleCache.clear()
+                return count.getCells(image, {**params, "backend": name})
+            backendCells[name], seconds = _timeit(getCells, repeats)
+            result = {**key, "backend": name, "seconds": seconds}
+            if trueCells is not None:
+                result.update(countAccuracy(backendCells[name], trueCells, tolerance = cellRadius))
+            else:
+                result["count"] = len(backendCells[name])
+            results.append(result)
+
+        referenceResult = results[-len(backendCells)]
+        referenceCells = np.array([(y, x) for x, y in backendCells[reference]], dtype = float).reshape(-1, 2)
+        for result in results[-len(backendCells):]:
+            result["speedup"] = referenceResult["seconds"] / result["seconds"]
+            result["countDifference"] = abs(result["count"] - referenceResult["count"]) / max(1, referenceResult["count"])
+            # fraction of reference cells found at (nearly) the same position
+            result["referenceMatched"] = countAccuracy(backendCells[result["backend"]], referenceCells, tolerance = cellRadius or 5)["recall"]
+
+    return {"environment": environment(),
+            "settings": count.countingSettings(),
+            "repeats": repeats,
+            "reference": reference,
+            "tolerance": tolerance,
+            "results": results,
+            "disagreements": [result for result in results if result["countDifference"] > tolerance]}
+
+
+def compareToBaseline(report, baseline, threshold = 0.1, minSeconds = 0.01):
+    """Find regressions of report compared to baseline report. Results are matched by image, size and seed.
+    Timings are only compared if both reports were made in the same environment (machine, cores and library
+    versions), counts and accuracy always.
+    :param float threshold: relative slowdown of a stage (or getCells) counted as regression
+    :param float minSeconds: stages faster than this in both reports are ignored (timer noise)
+    :return list[dict]: regressions"""
+    compareTimings = baseline.get("environment") == report["environment"]
+    baselineResults = {(r["image"], r["size"], r["seed"]): r for r in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        key = (result["image"], result["size"], result["seed"])
+        old = baselineResults.get(key)
+        if old is None:
+            continue
+        timings = {**result["stages"], "getCells": result["getCells"]}
+        oldTimings = {**old["stages"], "getCells": old["getCells"]}
+        for stage, seconds in timings.items():
+            if compareTimings and stage in oldTimings and max(seconds, oldTimings[stage]) > minSeconds and seconds > (1 + threshold) * oldTimings[stage]:
+                regressions.append({"image": key[0], "size": key[1], "seed": key[2], "stage": stage,
+                                    "seconds": seconds, "baselineSeconds": oldTimings[stage]})
+        for metric in ["precision", "recall"]:
+            if metric in old and result[metric] < old[metric]:
+                regressions.append({"image": key[0], "size": key[1], "seed": key[2], "metric": metric,
+                                    "value": result[metric], "baselineValue": old[metric]})
+        if "trueCount" not in old and result["count"] != old["count"]:
+            regressions.append({"image": key[0], "size": key[1], "seed": key[2], "metric": "count",
+                                "value": result["count"], "baselineValue": old["count"]})
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the counting pipeline on synthetic images.")
+    parser.add_argument("benchmark", choices = ["circle", "save", "pipeline", "backends"])
+    parser.add_argument("-r", "--repeats", type = int, default = 3, help = "best of n runs is reported")
+    parser.add_argument("-d", "--directory", default = None, help = "save: directory files are written to. default: temporary directory")
+    parser.add_argument("-o", "--output", default = None, help = "write report to file instead of stdout")
+    parser.add_argument("-s", "--sizes", type = int, nargs = "+", default = PIPELINE_SIZES, help = "pipeline, backends: image sizes")
+    parser.add_argument("--baseline", default = None, help = "pipeline: report to compare with, e.g. resources/benchmarkBaseline_<machine>.json. exit code is 1 if there are regressions")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "pipeline: relative slowdown counted as regression")
+    parser.add_argument("--tolerance", type = float, default = 0.05, help = "backends: maximal relative count difference to the reference backend. exit code is 1 if exceeded")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "circle":
+        results = benchmarkCircleDetection(repeats = args.repeats)
+    elif args.benchmark == "save":
+        results = benchmarkSave(directory = args.directory, repeats = args.repeats)
+    elif args.benchmark == "pipeline":
+        results = benchmarkPipeline(sizes = args.sizes, repeats = args.repeats)
+        if args.baseline is not None:
+            with open(args.baseline) as file:
+                baseline = json.load(file)
+            results["regressions"] = compareToBaseline(results, baseline, args.threshold)
+            results["threshold"] = args.threshold
+            # timings of another machine or other library versions are not comparable and were skipped
+            if baseline.get("environment") != results["environment"]:
+                results["baselineEnvironment"] = baseline.get("environment")
+                results["timingsCompared"] = False
+    elif args.benchmark == "backends":
+        results = benchmarkBackends(sizes = args.sizes, repeats = args.repeats, tolerance = args.tolerance)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent = 4)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent = 4)
+
+    if isinstance(results, dict) and (results.get("regressions") or results.get("disagreements")):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
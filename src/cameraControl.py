@@ -0,0 +1,119 @@
+"""Camera controls applied in process (V4L2 ioctl / cv2 properties) instead of spawning v4l2-ctl.
+Values already set are remembered, so only changed controls are sent to the camera (all again after a resolution switch)."""
+import os
+import time
+import struct
+
+from logger import logger
+
+
+# control ids from linux/v4l2-controls.h
+V4L2_CID_RED_BALANCE       = 0x0098090e
+V4L2_CID_BLUE_BALANCE      = 0x0098090f
+V4L2_CID_CAMERA_CLASS_BASE = 0x009a0900
+
+# names as used by v4l2-ctl
+CONTROLS = {
+    "red_balance"               : V4L2_CID_RED_BALANCE,
+    "blue_balance"              : V4L2_CID_BLUE_BALANCE,
+    "auto_exposure"             : V4L2_CID_CAMERA_CLASS_BASE + 1,
+    "exposure_time_absolute"    : V4L2_CID_CAMERA_CLASS_BASE + 2,
+    "exposure_dynamic_framerate": V4L2_CID_CAMERA_CLASS_BASE + 3,
+    "white_balance_auto_preset" : V4L2_CID_CAMERA_CLASS_BASE + 20,
+    "iso_sensitivity_auto"      : V4L2_CID_CAMERA_CLASS_BASE + 24,
+}
+
+# the camera may change these controls on its own if the key control changes, so they are sent again
+DEPENDENT_CONTROLS = {
+    "auto_exposure": ("exposure_time_absolute",),
+}
+
+VIDIOC_S_CTRL = 0xC008561C # _IOWR('V', 28, struct v4l2_control)
+V4L2_CONTROL_FORMAT = "Ii"  # struct v4l2_control {__u32 id; __s32 value;}
+
+
+class V4L2Backend():
+    """Set controls of a V4L2 device with ioctl. The device is opened once and kept open."""
+    def __init__(self, device = "/dev/video0"):
+        self.device = device
+        self.fd = None
+
+    def setControl(self, controlId, value):
+        import fcntl # linux only
+        if self.fd is None:
+            self.fd = os.open(self.device, os.O_RDWR | os.O_NONBLOCK)
+        fcntl.ioctl(self.fd, VIDIOC_S_CTRL, struct.pack(V4L2_CONTROL_FORMAT, controlId, int(value)))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class FakeBackend():
+    """Backend without camera (test mode). Records all calls and simulates the time needed per control."""
+    def __init__(self, delay = 0.0):
+        """:param float delay: seconds per setControl call"""
+        self.delay = delay
+        self.calls = [] # (controlId, value)
+
+    def setControl(self, controlId, value):
+        if self.delay:
+            time.sleep(self.delay)
+        self.calls.append((controlId, int(value)))
+
+    def close(self):
+        pass
+
+
+class CameraControl():
+    """Apply V4L2 controls and cv2.VideoCapture properties, skipping values that are already set."""
+    def __init__(self, cap, backend):
+        """:param cv2.VideoCapture cap: capture whose properties are set
+        :param backend: V4L2Backend or FakeBackend"""
+        self.cap = cap
+        self.backend = backend
+        self.controls   = {} # name: value last applied
+        self.properties = {} # cv2.CAP_PROP_*: value last applied
+
+    def setControls(self, controls):
+        """Apply controls in the given order.
+        :param dict controls: v4l2-ctl name (see CONTROLS): value
+        :return list: names of controls sent to the camera"""
+        changed = []
+        for name, value in controls.items():
+            if self.controls.get(name) == value:
+                continue
+            try:
+                self.backend.setControl(CONTROLS[name], value)
+            except OSError as e:
+                logger.warn(f"Could not set camera control {name}={value}: {e}")
+                self.controls.pop(name, None)
+                continue
+            self.controls[name] = value
+            for dependent in DEPENDENT_CONTROLS.get(name, ()):
+                self.controls.pop(dependent, None)
+            changed.append(name)
+        return changed
+
+    def setProperties(self, properties):
+        """Set properties of self.cap.
+        :param dict properties: cv2.CAP_PROP_*: value
+        :return list: properties set"""
+        changed = []
+        for prop, value in properties.items():
+            if self.properties.get(prop) == value:
+                continue
+            # failed properties are not remembered and tried again next time
+            if self.cap.set(prop, value):
+                self.properties[prop] = value
+            changed.append(prop)
+        return changed
+
+    def invalidate(self):
+        """Forget applied values (e.g. after the resolution was switched), everything is sent again on next call."""
+        self.controls  .clear()
+        self.properties.clear()
+
+    def close(self):
+        self.backend.close()
@@ -1,6 +1,7 @@
 """Buffer module to store constants and settings."""
 DISP_MSEC   = 50                # Delay between display cycles
 CAMERA_NUM = 1
+CAMERA_DEVICE = "/dev/video0"     # V4L2 device for camera controls
 
 GPIO_UV_LED = 32
 GPIO_COLOR_LED = 18
@@ -9,6 +10,8 @@ COLOR_LED_NUM = 40
 
 CAMERA_RESOLUTION  = (3040, 3040)
 DISPLAY_RESOLUTION = (480, 480)
+PREVIEW_REDUCE_FACTOR = 4       # downscaling of full image for counting settings preview
+PREVIEW_DEBOUNCE_MS   = 150     # counting settings preview starts after sliders did not move for this long
 
 RED_GAIN  = 4575
 BLUE_GAIN = 918
@@ -17,5 +20,64 @@ BLUE_GAIN = 918
 
 TEST_IMAGE_NAME = "testImage.tiff"
 
+# used for keys missing in settings["Counting"]
+COUNTING_DEFAULTS = {
+    "circleDetection": "full",      # "full" (single scale hough sweep) or "pyramid" (coarse to fine, faster)
+    "tileSize"       : 0,           # process getCellsFromMask in tiles of this size, one thread per core. about 40 % less peak memory,
+                                    # about 2x slower on a single core (halo is processed twice). 0: no tiling
+    "compactDtype"   : False,       # float32 intermediates computed in place to reduce peak memory
+    "backend"        : "skimage",   # "skimage" (reference) or "opencv" (faster, counts may differ slightly), see count.BACKENDS
+    "precount"       : False,       # start counting in background as soon as an image is captured
+    "liveCount"      : False,       # approximate count of preview frames shown as overlay
+    "liveInterval"   : 5,           # live count every n-th preview frame
+    "countPairs"     : False,       # Trigger + Save: count color and UV image together, written to <time>_paired.json
+    "additionalCut"  : 50,          # pixels cut from the dish radius
+    "threshold"      : 150,         # intensity threshold of b+g-0.5*r
+    "distanceSigma"  : 4,           # sigma of gaussian applied to distance transform
+    "imageSigma"     : 8,           # sigma of gaussian applied to image
+    "minDistance"    : 10,          # minimal distance between markers
+    "minArea"        : 1000,        # cells are regions with minArea < area < maxArea
+    "maxArea"        : 100000,
+    "maxAxisRatio"   : 3,           # and major axis length < maxAxisRatio * minor axis length
+    "uvThreshold"    : 100,         # paired counting: cells with mean b+g-0.5*r in the UV image above this are fluorescent
+}
+
+# used for keys missing in settings["Capture"]
+CAPTURE_DEFAULTS = {
+    "fullResolutionStream": False,  # stream at CAMERA_RESOLUTION, preview is downscaled and trigger takes latest frame
+}
+SNAPSHOT_TIMEOUT = 2            # seconds to wait for a frame of the full resolution stream
+
+# used for keys missing in settings["Color"] and settings["UV"]
+BURST_DEFAULTS = {
+    "burstFrames"  : 1,             # frames merged into one capture. 1: single frame
+    "burstMerge"   : "mean",        # "mean", "median" or "hdr" (exposure bracketing with hdrExposures)
+    "burstExposure": 1.0,           # exposure of burst frames relative to exposureTime ("mean" and "median")
+    "hdrExposures" : [0.25, 1, 4],  # exposures relative to exposureTime for "hdr", burstFrames frames each
+}
+EXPOSURE_SETTLE_FRAMES = 1      # frames dropped after changing the exposure within a burst
+
+# used for keys missing in settings["Save"]
+SAVE_DEFAULTS = {
+    "format"            : "tiff",     # "tiff", "png", "npz" (compressed numpy), "npy" (raw numpy dump) or "hdf5" (run archive, needs h5py)
+    "tiffCompression"   : "lzw",      # "none", "lzw", "deflate" or "zstd" (needs libtiff with zstd support)
+    "pngCompression"    : 1,          # 0 (fast, large) - 9 (slow, small)
+    "archiveCompression": "lzf",      # compression in run archive: "none" (memory mappable), "lzf" or "gzip"
+    "annotatedImage"    : False,      # save full size annotated image. cells are always saved in the json sidecar
+}
+
+# used for keys missing in settings["Profiling"]
+PROFILING_DEFAULTS = {
+    "enabled": False,               # time stages of counting, capturing and saving (logged)
+    "overlay": False,               # show last stage timings on screen
+}
+
+# used for keys missing in settings["ResultCache"]
+RESULT_CACHE_DEFAULTS = {
+    "enabled": True,                  # reuse results of images counted before with same parameters
+    "maxMB"  : 20,                    # least recently used results are removed above this size
+    "path"   : "resultCache.sqlite",  # sqlite file, relative to resources directory
+}
+
 
 settings = {}
@@ -1,85 +1,743 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 from scipy import ndimage as ndi
 
 from skimage.segmentation import  watershed
 from skimage.feature import peak_local_max, canny
-from skimage.measure import regionprops, block_reduce
+from skimage.measure import block_reduce
 from skimage.filters import  gaussian
 from skimage.transform import hough_circle
+from skimage.draw import circle_perimeter
 
 
 import numpy as np
 import cv2
 
+import constants
+from logger import logger
+from memoryUsage import resetPeakRSS, peakRSS
+from profiling import stage, timed
+from peakMarkers import findMarkersMasked
+
+
+def countingSettings():
+    """Return counting settings from constants.settings. Missing values are taken from constants.COUNTING_DEFAULTS."""
+    return {**constants.COUNTING_DEFAULTS, **constants.settings.get("Counting", {})}
+
+
+def scaleParams(params, factor):
+    """Counting parameters for an image downscaled by factor.
+    :return dict: scaled copy of params"""
+    params = dict(params)
+    for name in ["additionalCut", "distanceSigma", "imageSigma"]:
+        params[name] = params[name] / factor
+    params["minDistance"] = max(1, int(round(params["minDistance"] / factor)))
+    params["minArea"] = params["minArea"] / factor**2
+    params["maxArea"] = params["maxArea"] / factor**2
+    params["tileSize"] = 0
+    return params
+
+
+# stages reported to Checkpoint.progress
+COUNTING_STAGES = ["circle", "mixChannels", "distanceTransform", "smoothDistance", "smoothImage", "peakLocalMax", "watershed", "regionStatistics"]
+
+
+class CountingCancelled(Exception):
+    """Counting was cancelled by setting the cancel event."""
+
 
-def getCells(image):
-    r,g,b = cropCircleROI(image, additionalCut = 50)
+class Checkpoint():
+    """Called before every counting stage. Reports progress and stops counting if cancel event is set."""
+    def __init__(self, progress = None, cancel = None):
+        """:param callable progress: called with name of next stage (in COUNTING_STAGES) and fraction of stages done
+        :param threading.Event cancel: counting raises CountingCancelled at next checkpoint if set"""
+        self.progress = progress
+        self.cancel = cancel
 
-    # only use blue and green channel, substract red to avoid reflections
-    BGdata = b.astype(int)+g.astype(int)-0.5*r.astype(int)
+    def __call__(self, name):
+        self.check()
+        if self.progress is not None:
+            self.progress(name, COUNTING_STAGES.index(name) / len(COUNTING_STAGES))
 
-    threshold = 150
+    def check(self):
+        """Raise CountingCancelled if cancel event is set."""
+        if self.cancel is not None and self.cancel.is_set():
+            raise CountingCancelled()
 
-    BGdata = np.ma.filled(BGdata, 0)
 
-    cells = getCellsFromMask(BGdata > threshold, image = BGdata)
+@timed("count.getCells")
+def getCells(image, params = None, progress = None, cancel = None):
+    """Count cells in image.
+    :param np.ndarray image: RGB image (uint8 or uint16)
+    :param dict params: counting parameters overwriting countingSettings()
+    :param callable progress: called before every stage, see Checkpoint
+    :param threading.Event cancel: raise CountingCancelled at next stage if set
+    :return list: cell centroids as (x, y)"""
+    resetPeakRSS()
+    params = {**countingSettings(), **(params or {})}
+    checkpoint = Checkpoint(progress, cancel)
+
+    checkpoint("circle")
+    with stage("count.circle"):
+        circle = findDishCircle(image)
+    checkpoint("mixChannels")
+    with stage("count.mixChannels"):
+        BGdata = mixChannels(image, circle, params["additionalCut"], params["compactDtype"])
+
+    cells = getCellsFromMask(BGdata > params["threshold"], image = BGdata, params = params, checkpoint = checkpoint)
+
+    # peak of the whole process, see memoryUsage. only the memory of this counting if the process is otherwise idle
+    logger.info(f"Counting peak RSS (process): {peakRSS():.0f} MB")
 
     return [(int(cell[1]),int(cell[0])) for cell in cells]
 
 
+@timed("count.getCellsPaired")
+def getCellsPaired(image, uvImage, params = None, progress = None, cancel = None):
+    """Count cells in color image and classify them as fluorescent by their mean intensity in the UV image of the
+    same dish. Dish circle and segmentation of the color image are used for both images, so this is only slightly
+    slower than getCells(image).
+    :param np.ndarray image: RGB image
+    :param np.ndarray uvImage: RGB image taken with UV light, same size as image
+    :param dict params: counting parameters overwriting countingSettings(), cells with mean b+g-0.5*r in uvImage
+                        above params["uvThreshold"] are fluorescent
+    :return tuple: cell centroids as (x, y), list of bool (cell is fluorescent)"""
+    resetPeakRSS()
+    params = {**countingSettings(), **(params or {})}
+    checkpoint = Checkpoint(progress, cancel)
+
+    checkpoint("circle")
+    with stage("count.circle"):
+        circle = findDishCircle(image)
+    checkpoint("mixChannels")
+    with stage("count.mixChannels"):
+        BGdata = mixChannels(image, circle, params["additionalCut"], params["compactDtype"])
 
+    _, labels = getCellsFromMask(BGdata > params["threshold"], image = BGdata, returnLabels = True, params = params, checkpoint = checkpoint)
+    del BGdata
 
+    checkpoint.check()
+    with stage("count.uvClassification"):
+        UVdata = mixChannels(uvImage, circle, params["additionalCut"], params["compactDtype"])
+        stats = labelStatistics(labels, intensity = UVdata)
+        filtered = regionFilter(stats, params)
+        fluorescent = stats["meanIntensity"][filtered] > params["uvThreshold"]
 
-def cropCircleROI(image, additionalCut = 5):
-    """Return array masked outside circle with most dominant edges.
-    :returny list[array]: masked arrays split by channels"""
-    Rmin = np.min(image.shape[:-1])/3
-    Rmin = 1250 / 3040 * image.shape[0]
-    Rmax = 1400 / 3040 * image.shape[0]
+    # peak of the whole process, see memoryUsage. only the memory of this counting if the process is otherwise idle
+    logger.info(f"Counting peak RSS (process): {peakRSS():.0f} MB")
 
-    #downscale image for better performance
-    reduceFactor = 5 # squared
-    hough_radii = np.arange(Rmin/reduceFactor, Rmax/reduceFactor, dtype = int)
+    cells = [(int(col), int(row)) for row, col in zip(stats["centroidRow"][filtered], stats["centroidCol"][filtered])]
+    return cells, fluorescent.tolist()
 
-    downSampledImage = block_reduce(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), block_size = (reduceFactor, reduceFactor), func = np.max)
-    downSampledEdges = canny(downSampledImage, sigma=3, low_threshold=5, high_threshold=10)
 
-    hough_res = hough_circle(downSampledEdges, hough_radii)
-    downSampledCircle = np.unravel_index(np.argmax(hough_res, axis=None), hough_res.shape)
-    circle = np.array([downSampledCircle[1], downSampledCircle[2], hough_radii[downSampledCircle[0]]])*reduceFactor
+def getCellsApproximate(image, params = None):
+    """Fast approximate cell centers for live preview: local maxima of the gaussian smoothed mixed image inside
+    of cell pixels. No distance transform, watershed or shape filter. The dish circle is taken from circleCache.
+    :param np.ndarray image: RGB image
+    :param dict params: counting parameters for the resolution of image (see scaleParams)
+    :return list: cell centroids as (x, y)"""
+    params = {**countingSettings(), **(params or {})}
+    BGdata = mixChannels(image, findDishCircle(image), params["additionalCut"], compact = True)
+    smoothed = smooth(BGdata, params["imageSigma"], compact = True)
+    peaks = peak_local_max(smoothed, min_distance = params["minDistance"], exclude_border = False)
+    peaks = peaks[BGdata[peaks[:,0], peaks[:,1]] > params["threshold"]]
+    return [(int(col), int(row)) for row, col in peaks]
 
-    circleMask_ = cv2.circle(np.ones(image.shape[:-1],dtype = "uint8"), (circle[1], circle[0]), circle[2]-additionalCut, 0, thickness = -1)
 
-    return [np.ma.array(image[:,:,i], mask = circleMask_) for i in range (image.shape[2])]
+def circleMask(shape, circle, additionalCut = 5):
+    """:return np.ndarray: uint8 image, 1 outside of circle with radius reduced by additionalCut"""
+    return cv2.circle(np.ones(shape[:2], dtype = np.uint8), (int(circle[1]), int(circle[0])), int(circle[2]-additionalCut), 0, thickness = -1)
 
 
+def mixChannels(image, circle, additionalCut = 5, compact = False, outside = None):
+    """Same as b+g-0.5*r of cropCircleROI(image) filled with 0 outside of circle, but computed in place.
+    Only blue and green channel are used, red is substracted to avoid reflections.
+    :param np.ndarray circle: row, column and radius of dish
+    :param bool compact: float32 instead of float64 (values are multiples of 0.5 and exact in both)
+    :param np.ndarray outside: circleMask of circle if already computed
+    :return np.ndarray: mixed image"""
+    if outside is None:
+        outside = circleMask(image.shape, circle, additionalCut)
 
+    BGdata = image[:,:,0].astype(np.float32 if compact else np.float64)
+    BGdata *= -0.5
+    BGdata += image[:,:,1]
+    BGdata += image[:,:,2]
+    np.copyto(BGdata, 0, where = outside.view(bool))
+    return BGdata
 
 
 
 
-def getCellsFromMask(mask, image = None, returnLabels = False):
 
+CIRCLE_REDUCE_FACTOR        = 5    # downscaling (per axis) used for circle detection
+CIRCLE_COARSE_REDUCE_FACTOR = 20   # downscaling of first level in "pyramid" circle detection
+CIRCLE_CACHE_TOLERANCE      = 0.8  # cached circle is reused while its edge support is above this fraction of its initial support
+CIRCLE_MIN_SUPPORT          = 0.5  # and above this fraction in any case
+CIRCLE_SEARCH_WINDOW        = 4    # half width (downscaled pixels) of center/radius window searched around the cached circle
 
-    data1 = gaussian(ndi.distance_transform_edt(mask), sigma = 4, preserve_range = True) 
-    data2 = gaussian(image, sigma = 8, preserve_range = True)
 
-    data = data1/np.max(data1) + data2/np.max(data2) 
+def circleReduceFactors(shape):
+    """Downscaling factors of circle detection for an image of shape. CIRCLE_REDUCE_FACTOR and
+    CIRCLE_COARSE_REDUCE_FACTOR are meant for camera resolution, smaller images (live preview) are reduced less.
+    Factors are rounded up, so the downscaled images (and hough accumulators) are never larger than at camera resolution.
+    :return tuple: reduce factor, coarse reduce factor (multiple of reduce factor)"""
+    scale = shape[0] / constants.CAMERA_RESOLUTION[0]
+    reduceFactor = max(1, int(np.ceil(CIRCLE_REDUCE_FACTOR * scale - 1e-9)))
+    coarseFactor = max(1, int(np.ceil(CIRCLE_COARSE_REDUCE_FACTOR * scale / reduceFactor - 1e-9)))
+    return reduceFactor, coarseFactor * reduceFactor
 
 
-    local_maxi = peak_local_max(data, indices=False, min_distance=10)
-    markers = ndi.label(local_maxi)[0]
-    labels = watershed(-data, markers, mask= mask)
+class CircleCache():
+    """Stores the last detected dish circle per camera geometry (image shape), in pixels of the downscaled image
+    (circleReduceFactors) before refinement, and its edge support."""
+    def __init__(self):
+        self._circles = {}
+
+    def get(self, key):
+        """:return tuple: (circle, support) or None"""
+        return self._circles.get(key)
 
-    connectedRegions = regionprops(labels)
+    def set(self, key, circle, support):
+        self._circles[key] = (circle, support)
 
-    # shape filter
-    connectedRegions_shapeFiltered = [reg for reg in connectedRegions if reg.major_axis_length < 3 * reg.minor_axis_length]
-    # area filter
-    filteredRegions = [reg for reg in connectedRegions_shapeFiltered if reg.area > 1000 and reg.area < 1e5]
+    def clear(self):
+        self._circles = {}
 
-    cells = [reg.centroid for reg in filteredRegions]
+circleCache = CircleCache()
+
+
+def cropCircleROI(image, additionalCut = 5, useCache = True):
+    """Return array masked outside circle with most dominant edges.
+    :param bool useCache: reuse circle found in previous images of same size if it still fits
+    :returny list[array]: masked arrays split by channels"""
+    circle = findDishCircle(image, useCache = useCache)
+
+    circleMask_ = cv2.circle(np.ones(image.shape[:-1],dtype = "uint8"), (circle[1], circle[0]), circle[2]-additionalCut, 0, thickness = -1)
+
+    return [np.ma.array(image[:,:,i], mask = circleMask_) for i in range (image.shape[2])]
+
+
+def findDishCircle(image, useCache = True):
+    """Find circle with most dominant edges.
+    With a cached circle only a narrow window around it is searched, with the same score as the full detection, so
+    the result is the same as long as the dish moved less than CIRCLE_SEARCH_WINDOW. The full detection
+    (settings["Counting"]["circleDetection"]) is done if the edge support of the found circle dropped.
+    :param bool useCache: use/update circleCache
+    :return np.ndarray: row, column and radius of circle in pixels"""
+    with stage("count.circleDownscale"):
+        gray, downSampledImage, reduceFactor, coarseReduceFactor = circleImages(image)
+    with stage("count.circleEdges"):
+        downSampledEdges = circleEdges(downSampledImage)
+
+    # edges dilated by one pixel to tolerate rasterisation of the circle when validating
+    edges = cv2.dilate(downSampledEdges.astype(np.uint8), np.ones((3,3), np.uint8)).astype(bool)
+
+    key = image.shape[:2]
+    cached = circleCache.get(key) if useCache else None
+    downSampledCircle = None
+    if cached is not None:
+        cachedCircle, cachedSupport = cached
+        with stage("count.circleLocalSearch"):
+            circle = localCircleSearch(downSampledEdges, cachedCircle, CIRCLE_SEARCH_WINDOW)
+        if circleSupport(edges, circle[None,:])[0] >= max(CIRCLE_CACHE_TOLERANCE * cachedSupport, CIRCLE_MIN_SUPPORT):
+            downSampledCircle = circle
+            circleCache.set(key, circle, cachedSupport)
+
+    if downSampledCircle is None:
+        with stage("count.circleSearch"):
+            downSampledCircle = searchCircle(downSampledImage, downSampledEdges, image.shape, reduceFactor, coarseReduceFactor)
+        if useCache:
+            circleCache.set(key, downSampledCircle, circleSupport(edges, downSampledCircle[None,:])[0])
+
+    with stage("count.circleRefine"):
+        return upscaleCircle(gray, downSampledCircle, reduceFactor)
+
+
+def circleImages(image):
+    """Gray image and its block maximum downscaled by circleReduceFactors.
+    :return tuple: gray, downscaled gray, reduce factor, coarse reduce factor"""
+    reduceFactor, coarseReduceFactor = circleReduceFactors(image.shape)
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return gray, block_reduce(gray, block_size = (reduceFactor, reduceFactor), func = np.max), reduceFactor, coarseReduceFactor
+
+
+def circleEdges(downSampledImage):
+    """:return np.ndarray: boolean canny edges used for circle detection"""
+    return canny(downSampledImage, sigma=3, low_threshold=5, high_threshold=10)
+
+
+def searchCircle(downSampledImage, downSampledEdges, shape, reduceFactor, coarseReduceFactor):
+    """Full circle detection selected by settings["Counting"]["circleDetection"].
+    :param tuple shape: shape of full image
+    :return np.ndarray: row, column and radius of circle in pixels of downSampledImage"""
+    Rmin = 1250 / 3040 * shape[0]
+    Rmax = 1400 / 3040 * shape[0]
+    if countingSettings()["circleDetection"] == "pyramid":
+        return pyramidCircleSearch(downSampledImage, downSampledEdges, Rmin, Rmax, reduceFactor, coarseReduceFactor)
+    hough_radii = np.arange(Rmin/reduceFactor, Rmax/reduceFactor, dtype = int)
+    return houghCircleSweep(downSampledEdges, hough_radii)
+
+
+def upscaleCircle(gray, downSampledCircle, reduceFactor):
+    """Circle in pixels of the full image, refined at full resolution for "pyramid" circle detection.
+    :return np.ndarray: row, column and radius of circle in pixels"""
+    if countingSettings()["circleDetection"] == "pyramid":
+        return refineCircle(gray, downSampledCircle*reduceFactor, 4*reduceFactor)
+    return downSampledCircle*reduceFactor
+
+
+def houghCircleSweep(edges, radii):
+    """Hough sweep over all radii and the full image.
+    :return np.ndarray: row, column and radius of best circle in pixels of edges"""
+    hough_res = hough_circle(edges, radii)
+    peak = np.unravel_index(np.argmax(hough_res, axis=None), hough_res.shape)
+    return np.array([peak[1], peak[2], radii[peak[0]]])
+
+
+def pyramidCircleSearch(downSampledImage, downSampledEdges, Rmin, Rmax,
+                        reduceFactor = CIRCLE_REDUCE_FACTOR, coarseReduceFactor = CIRCLE_COARSE_REDUCE_FACTOR):
+    """Coarse to fine circle search. Hough sweep at coarseReduceFactor, refined in a small window at reduceFactor.
+    The result is refined at full resolution by refineCircle.
+    :param np.ndarray downSampledImage: gray image reduced by reduceFactor
+    :param np.ndarray downSampledEdges: edges of downSampledImage
+    :return np.ndarray: row, column and radius of circle in pixels of downSampledImage"""
+    coarseFactor = coarseReduceFactor // reduceFactor
+
+    coarseImage = block_reduce(downSampledImage, block_size = (coarseFactor, coarseFactor), func = np.max)
+    coarseEdges = canny(coarseImage, sigma=1, low_threshold=5, high_threshold=10)
+    coarseRadii = np.arange(Rmin/coarseReduceFactor, Rmax/coarseReduceFactor + 1, dtype = int)
+    circle = houghCircleSweep(coarseEdges, coarseRadii)*coarseFactor
+
+    return localCircleSearch(downSampledEdges, circle, coarseFactor)
+
+
+def refineCircle(gray, circle, window, numAngles = 1440):
+    """Move circle to the strongest radial edge within +-window pixels by a least squares fit.
+    :param np.ndarray gray: gray image
+    :param np.ndarray circle: row, column and radius of initial circle
+    :return np.ndarray: row, column and radius of refined circle"""
+    angles = np.linspace(0, 2*np.pi, numAngles, endpoint = False)
+
+    # second pass in narrow window around first fit
+    for window in [window, 2]:
+        radii = circle[2] + np.arange(-window-1, window+2)
+        rows = np.rint(circle[0] + radii[None,:] * np.sin(angles)[:,None]).astype(int)
+        cols = np.rint(circle[1] + radii[None,:] * np.cos(angles)[:,None]).astype(int)
+        inside = np.all((rows >= 0) & (rows < gray.shape[0]) & (cols >= 0) & (cols < gray.shape[1]), axis = 1)
+        if np.count_nonzero(inside) < numAngles // 4:
+            return np.rint(circle).astype(int)
+
+        # radial profiles, edge at strongest central difference. only use edges with the dominant polarity
+        profiles = gray[rows[inside], cols[inside]].astype(np.float32)
+        gradient = profiles[:,2:] - profiles[:,:-2]
+        strongest = np.take_along_axis(gradient, np.argmax(np.abs(gradient), axis = 1)[:,None], axis = 1)
+        gradient *= np.sign(np.median(strongest)) or 1
+        edgeRadii = radii[1:-1][np.argmax(gradient, axis = 1)]
+        pointsRow = circle[0] + edgeRadii * np.sin(angles[inside])
+        pointsCol = circle[1] + edgeRadii * np.cos(angles[inside])
+
+        # algebraic circle fit, refit once without outliers
+        valid = np.ones(len(pointsRow), dtype = bool)
+        for _ in range(2):
+            A = np.stack([2*pointsRow[valid], 2*pointsCol[valid], np.ones(np.count_nonzero(valid))], axis = 1)
+            (centerRow, centerCol, c), *_ = np.linalg.lstsq(A, pointsRow[valid]**2 + pointsCol[valid]**2, rcond = None)
+            radius = np.sqrt(c + centerRow**2 + centerCol**2)
+            valid = np.abs(np.hypot(pointsRow - centerRow, pointsCol - centerCol) - radius) < 2
+            if np.count_nonzero(valid) < 3:
+                return np.rint(circle).astype(int)
+        circle = np.array([centerRow, centerCol, radius])
+
+    return np.rint(circle).astype(int)
+
+
+def circleSupport(edges, circles, numSamples = 720):
+    """Fraction of points on each circle lying on an edge.
+    :param np.ndarray edges: boolean edge image
+    :param np.ndarray circles: shape (n, 3) with row, column, radius
+    :return np.ndarray: support for each circle, shape (n,)"""
+    angles = np.linspace(0, 2*np.pi, numSamples, endpoint = False)
+    rows = np.rint(circles[:,0,None] + circles[:,2,None] * np.sin(angles)).astype(int)
+    cols = np.rint(circles[:,1,None] + circles[:,2,None] * np.cos(angles)).astype(int)
+    inside = (rows >= 0) & (rows < edges.shape[0]) & (cols >= 0) & (cols < edges.shape[1])
+    hits = edges[np.clip(rows, 0, edges.shape[0]-1), np.clip(cols, 0, edges.shape[1]-1)] & inside
+    return hits.mean(axis = 1)
+
+
+def houghScore(edges, circles):
+    """Normalised hough_circle accumulator of each circle: fraction of its perimeter pixels (circle_perimeter) lying
+    on an edge. Same score as houghCircleSweep, computed for the given circles only.
+    :param np.ndarray edges: boolean edge image
+    :param np.ndarray circles: shape (n, 3) with row, column, radius (integer)
+    :return np.ndarray: score for each circle, shape (n,)"""
+    circles = np.rint(circles).astype(int)
+    scores = np.zeros(len(circles))
+    for radius in np.unique(circles[:,2]):
+        selected = circles[:,2] == radius
+        offsetRows, offsetCols = circle_perimeter(0, 0, radius)
+        rows = circles[selected,0,None] + offsetRows
+        cols = circles[selected,1,None] + offsetCols
+        inside = (rows >= 0) & (rows < edges.shape[0]) & (cols >= 0) & (cols < edges.shape[1])
+        hits = edges[np.clip(rows, 0, edges.shape[0]-1), np.clip(cols, 0, edges.shape[1]-1)] & inside
+        scores[selected] = hits.mean(axis = 1)
+    return scores
+
+
+def localCircleSearch(edges, circle, window):
+    """Exhaustive search for the circle with highest houghScore with center and radius within +-window of circle.
+    Candidates are ordered like the hough accumulator (radius, row, column), so ties are broken the same way.
+    :return np.ndarray: best circle (row, column, radius)"""
+    offsets = np.arange(-window, window+1)
+    dRadius, dRow, dCol = np.meshgrid(offsets, offsets, offsets, indexing = "ij")
+    candidates = np.rint(circle).astype(int) + np.stack([dRow.ravel(), dCol.ravel(), dRadius.ravel()], axis = 1)
+
+    return candidates[np.argmax(houghScore(edges, candidates))]
+
+
+
+
+
+
+TILE_HALO   = 256  # overlap of tiles. tiled results are identical as long as cells/mask components are smaller than this
+
+
+def cropMargin(params):
+    """Margin around dish bounding box. Larger than gaussian radius (4*sigma) + 2*minDistance, so cropping does not
+    change the result."""
+    return int(4 * max(params["distanceSigma"], params["imageSigma"])) + 2 * params["minDistance"] + 2
+
+
+def getCellsFromMask(mask, image = None, returnLabels = False, params = None, checkpoint = None):
+    """Find cells by watershed segmentation of mask. Only the bounding box of the dish (non zero part of image) is
+    processed, optionally split in overlapping tiles processed in parallel (settings["Counting"]["tileSize"]).
+    :param np.ndarray mask: boolean mask of cell pixels
+    :param np.ndarray image: intensity image, zero outside of dish
+    :param bool returnLabels: additionally return label image
+    :param dict params: counting parameters overwriting countingSettings()
+    :param Checkpoint checkpoint: called before every stage
+    :return list: centroids (row, column) of cells"""
+    params = {**countingSettings(), **(params or {})}
+    checkpoint = checkpoint or Checkpoint()
+    crop = dishBoundingBox(image, cropMargin(params))
+
+    if params["tileSize"]:
+        cells, cropLabels = _getCellsFromMaskTiled(mask[crop], image[crop], params, checkpoint)
+    else:
+        cells, cropLabels = _getCellsFromMask(mask[crop], image[crop], params, checkpoint)
+
+    cells = [(row + crop[0].start, col + crop[1].start) for row, col in cells]
 
     if returnLabels:
+        labels = np.zeros(mask.shape, dtype = cropLabels.dtype)
+        labels[crop] = cropLabels
         return cells, labels
     return cells
 
+
+def dishBoundingBox(image, margin):
+    """Bounding box of non zero part of image.
+    :param int margin: added on each side, clipped to image shape
+    :return tuple: slices for rows and columns"""
+    rows = np.flatnonzero(np.any(image, axis = 1))
+    cols = np.flatnonzero(np.any(image, axis = 0))
+    if len(rows) == 0:
+        return (slice(0, image.shape[0]), slice(0, image.shape[1]))
+    return (slice(max(0, rows[0] - margin), min(image.shape[0], rows[-1] + margin + 1)),
+            slice(max(0, cols[0] - margin), min(image.shape[1], cols[-1] + margin + 1)))
+
+
+def _getCellsFromMask(mask, image, params, checkpoint):
+    """:return tuple: centroids and labels"""
+    compact = params["compactDtype"]
+    backend = getBackend(params)
+    checkpoint("distanceTransform")
+    with stage("count.distanceTransform"):
+        distance = backend.distanceTransform(mask, compact)
+    checkpoint("smoothDistance")
+    with stage("count.smoothDistance"):
+        data1 = backend.smooth(distance, params["distanceSigma"], compact)
+    checkpoint("smoothImage")
+    with stage("count.smoothImage"):
+        data2 = backend.smooth(image, params["imageSigma"], compact)
+
+    data = combineSmoothed(data1, data2, inPlace = True)
+
+    checkpoint("peakLocalMax")
+    with stage("count.peakLocalMax"):
+        markers = backend.findMarkers(data, mask, params["minDistance"])
+    checkpoint("watershed")
+    with stage("count.watershed"):
+        labels = backend.segment(data, markers, mask, inPlace = True)
+
+    checkpoint("regionStatistics")
+    with stage("count.regionStatistics"):
+        cells = filterRegions(labels, params)
+    return cells, labels
+
+
+def tileWorkers():
+    """Threads processing tiles: one per usable core. More threads only hold more tile intermediates in memory."""
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+def _getCellsFromMaskTiled(mask, image, params, checkpoint, halo = TILE_HALO):
+    """Same as _getCellsFromMask, but every step is done on overlapping tiles in a thread pool (tileWorkers()).
+    Only the combined smoothed data, markers and labels are kept at full size, so peak memory is lower.
+    The halo is processed by both neighbouring tiles, so it is slower on a single core.
+    Cancelling is checked before every tile.
+    :return tuple: centroids and labels"""
+    tiles = list(_tiles(mask.shape, params["tileSize"], halo))
+    compact = params["compactDtype"]
+    backend = getBackend(params)
+
+    data1 = np.empty(mask.shape, dtype = np.float32 if compact else np.float64)
+    data2 = np.empty(mask.shape, dtype = np.float32 if compact else np.float64)
+    def smoothTile(tile):
+        checkpoint.check()
+        core, outer, inner = tile
+        data1[core] = backend.smooth(backend.distanceTransform(mask[outer], compact), params["distanceSigma"], compact)[inner]
+        data2[core] = backend.smooth(image[outer], params["imageSigma"], compact)[inner]
+
+    with ThreadPoolExecutor(max_workers = tileWorkers()) as executor:
+        checkpoint("distanceTransform")
+        with stage("count.tiledSmooth"):
+            list(executor.map(smoothTile, tiles))
+
+        # combined into data1, data2 is freed before markers and labels are allocated
+        data = combineSmoothed(data1, data2, inPlace = True)
+        del data1, data2
+
+        # threshold of full image, default would be minimum of each tile
+        threshold = np.min(data)
+        local_maxi = np.zeros(mask.shape, dtype = bool)
+        def findPeaks(tile):
+            checkpoint.check()
+            core, outer, inner = tile
+            # maxima inside of mask, labelled again for the whole image. same markers as findMarkers of the whole image
+            local_maxi[core] = backend.findMarkers(data[outer], mask[outer], params["minDistance"], threshold)[inner] > 0
+
+        checkpoint("peakLocalMax")
+        with stage("count.tiledPeakLocalMax"):
+            list(executor.map(findPeaks, tiles))
+            markers = backend.label(local_maxi)
+
+        # keep regions with centroid in core of tile. regions cut by the tile border are found by neighbouring tile
+        labels = np.zeros(mask.shape, dtype = markers.dtype)
+        def flood(tile):
+            checkpoint.check()
+            _, outer, inner = tile
+            tileLabels = backend.segment(data[outer], markers[outer], mask[outer])
+            stats = labelStatistics(tileLabels)
+            inCore = ((inner[0].start <= stats["centroidRow"]) & (stats["centroidRow"] < inner[0].stop) &
+                      (inner[1].start <= stats["centroidCol"]) & (stats["centroidCol"] < inner[1].stop))
+            keepMask = np.isin(tileLabels, stats["label"][inCore])
+            labels[outer][keepMask] = tileLabels[keepMask]
+
+        checkpoint("watershed")
+        with stage("count.tiledWatershed"):
+            list(executor.map(flood, tiles))
+
+    checkpoint("regionStatistics")
+    with stage("count.regionStatistics"):
+        cells = filterRegions(labels, params)
+    return cells, labels
+
+
+def distanceTransform(mask, compact = False):
+    """Euclidean distance to closest background pixel. float32 (cv2) if compact, float64 (scipy) otherwise."""
+    if compact:
+        return cv2.distanceTransform(mask.view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return ndi.distance_transform_edt(mask)
+
+
+def smooth(data, sigma, compact = False):
+    """Gaussian filter. float32 output if compact, float64 otherwise."""
+    if compact:
+        # skimage's gaussian converts to float64, ndi.gaussian_filter with same mode/truncate can write float32 directly
+        return ndi.gaussian_filter(data, sigma = sigma, output = np.float32, mode = "nearest", truncate = 4.0)
+    return gaussian(data, sigma = sigma, preserve_range = True)
+
+
+def combineSmoothed(data1, data2, inPlace = False):
+    """data1/max(data1) + data2/max(data2).
+    :param bool inPlace: overwrite data1 and data2. float64 results are identical to inPlace = False"""
+    max1, max2 = np.max(data1), np.max(data2)
+    if inPlace and data1.dtype == np.float32:
+        data1 *= 1 / max1
+        data2 *= 1 / max2
+        data1 += data2
+        return data1
+    if inPlace and data1.dtype == np.float64:
+        np.divide(data1, max1, out = data1)
+        np.divide(data2, max2, out = data2)
+        data1 += data2
+        return data1
+    return data1/max1 + data2/max2
+
+
+def segment(data, markers, mask, inPlace = False):
+    """Watershed of -data.
+    :param bool inPlace: negate data in place (only for float32)
+    :return np.ndarray: labels"""
+    if inPlace and data.dtype == np.float32:
+        return watershed(np.negative(data, out = data), markers, mask = mask)
+    return watershed(-data, markers, mask = mask)
+
+
+class SkimageBackend():
+    """Reference implementation of the primitives of getCellsFromMask with scikit-image and scipy.
+    A backend implements the methods of this class and is registered with registerBackend."""
+    def distanceTransform(self, mask, compact = False):
+        return distanceTransform(mask, compact)
+
+    def smooth(self, data, sigma, compact = False):
+        return smooth(data, sigma, compact)
+
+    def localMaxima(self, data, minDistance, threshold = None):
+        """:return np.ndarray: boolean image of local maxima found by peak_local_max"""
+        peaks = np.zeros(data.shape, dtype = bool)
+        peaks[tuple(peak_local_max(data, min_distance=minDistance, threshold_abs = threshold).T)] = True
+        return peaks
+
+    def label(self, localMaxima):
+        """:return np.ndarray: markers (4-connected components of localMaxima)"""
+        return ndi.label(localMaxima)[0]
+
+    def findMarkers(self, data, mask, minDistance, threshold = None):
+        """Labelled local maxima inside of mask. Fused maximum search and labelling (numba if installed), same
+        segmentation as label(localMaxima(data, minDistance)), because markers outside of mask are ignored by segment.
+        :param float threshold: see localMaxima
+        :return np.ndarray: markers"""
+        return findMarkersMasked(data, mask, minDistance, threshold)
+
+    def segment(self, data, markers, mask, inPlace = False):
+        return segment(data, markers, mask, inPlace)
+
+
+class OpenCVBackend(SkimageBackend):
+    """Same primitives with cv2, float32 throughout. The watershed is the one of the reference: cv2.watershed floods
+    an 8-bit image, which merges touching cells, and the watershed is only a small part of the counting time.
+    benchmark.py backends checks the agreement of counts."""
+    def distanceTransform(self, mask, compact = False):
+        return cv2.distanceTransform(mask.view(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+
+    def smooth(self, data, sigma, compact = False):
+        # kernel truncated at 4 sigma as in the reference, border replicated as mode "nearest"
+        radius = int(4 * sigma + 0.5)
+        return cv2.GaussianBlur(data.astype(np.float32, copy = False), (2*radius + 1, 2*radius + 1), sigma, borderType = cv2.BORDER_REPLICATE)
+
+    def localMaxima(self, data, minDistance, threshold = None):
+        # maximum filter by dilation, border of minDistance excluded as in peak_local_max
+        size = 2*minDistance + 1
+        peaks = data == cv2.dilate(data, cv2.getStructuringElement(cv2.MORPH_RECT, (size, size)))
+        peaks &= data > (np.min(data) if threshold is None else threshold)
+        peaks[:minDistance] = peaks[-minDistance:] = False
+        peaks[:,:minDistance] = peaks[:,-minDistance:] = False
+        return peaks
+
+    def label(self, localMaxima):
+        return cv2.connectedComponents(localMaxima.view(np.uint8), connectivity = 4, ltype = cv2.CV_32S)[1]
+
+
+BACKENDS = {} # name: backend, selected by settings["Counting"]["backend"]
+
+
+def registerBackend(name, backend):
+    """Make backend available as settings["Counting"]["backend"].
+    :param object backend: implements the methods of SkimageBackend"""
+    BACKENDS[name] = backend
+
+
+def getBackend(params = None):
+    """:param dict params: counting parameters, default countingSettings()
+    :return object: backend selected by params["backend"]"""
+    name = (params or countingSettings())["backend"]
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown counting backend {name}, use one of {list(BACKENDS)}")
+    return BACKENDS[name]
+
+
+registerBackend("skimage", SkimageBackend())
+registerBackend("opencv" , OpenCVBackend())
+
+
+def _tiles(shape, tileSize, halo):
+    """Split shape into tiles.
+    :return generator: tuples of core slices, slices of core with halo and core slices relative to halo"""
+    for rowStart in range(0, shape[0], tileSize):
+        for colStart in range(0, shape[1], tileSize):
+            core  = (slice(rowStart, min(rowStart + tileSize, shape[0])), slice(colStart, min(colStart + tileSize, shape[1])))
+            outer = tuple(slice(max(0, s.start - halo), min(n, s.stop + halo)) for s, n in zip(core, shape))
+            inner = tuple(slice(s.start - o.start, s.stop - o.start) for s, o in zip(core, outer))
+            yield core, outer, inner
+
+
+def filterRegions(labels, params):
+    """Apply shape and area filter.
+    :param np.ndarray labels: label image
+    :param dict params: counting parameters
+    :return list: centroids of remaining regions"""
+    return filterStatistics(labelStatistics(labels), params)
+
+
+def filterStatistics(stats, params):
+    """Apply shape and area filter.
+    :param dict stats: result of labelStatistics
+    :param dict params: counting parameters
+    :return list: centroids of remaining regions"""
+    filtered = regionFilter(stats, params)
+    return list(zip(stats["centroidRow"][filtered], stats["centroidCol"][filtered]))
+
+
+def regionFilter(stats, params):
+    """:param dict stats: result of labelStatistics
+    :return np.ndarray: bool, region passes shape and area filter"""
+    # shape filter
+    shapeFilter = stats["majorAxisLength"] < params["maxAxisRatio"] * stats["minorAxisLength"]
+    # area filter
+    areaFilter = (stats["area"] > params["minArea"]) & (stats["area"] < params["maxArea"])
+
+    return shapeFilter & areaFilter
+
+
+def labelStatistics(labels, intensity = None):
+    """Area, centroid and axis lengths (as defined by skimage.measure.regionprops) of all labels at once.
+    :param np.ndarray labels: label image, 0 is background
+    :param np.ndarray intensity: image of same shape, adds "meanIntensity" of every label
+    :return dict: arrays of "label", "area", "centroidRow", "centroidCol", "majorAxisLength", "minorAxisLength",
+                  only for labels present in image, sorted by label"""
+    rows, cols = np.nonzero(labels)
+    ids = labels[rows, cols]
+    numLabels = int(ids.max()) + 1 if len(ids) else 1
+
+    area = np.bincount(ids, minlength = numLabels)
+    present = np.flatnonzero(area)
+    area = area[present]
+
+    centroidRow = np.bincount(ids, weights = rows, minlength = numLabels)[present] / area
+    centroidCol = np.bincount(ids, weights = cols, minlength = numLabels)[present] / area
+
+    # central moments of second order, normalised by area (= inertia tensor)
+    index = np.zeros(numLabels, dtype = np.intp)
+    index[present] = np.arange(len(present))
+    dRow = rows - centroidRow[index[ids]]
+    dCol = cols - centroidCol[index[ids]]
+    mu20 = np.bincount(ids, weights = dRow * dRow, minlength = numLabels)[present] / area
+    mu02 = np.bincount(ids, weights = dCol * dCol, minlength = numLabels)[present] / area
+    mu11 = np.bincount(ids, weights = dRow * dCol, minlength = numLabels)[present] / area
+
+    # eigenvalues of inertia tensor
+    mean  = (mu20 + mu02) / 2
+    delta = np.sqrt(((mu20 - mu02) / 2)**2 + mu11**2)
+    stats = {"label"          : present,
+             "area"           : area,
+             "centroidRow"    : centroidRow,
+             "centroidCol"    : centroidCol,
+             "majorAxisLength": 4 * np.sqrt(np.maximum(mean + delta, 0)),
+             "minorAxisLength": 4 * np.sqrt(np.maximum(mean - delta, 0))}
+    if intensity is not None:
+        stats["meanIntensity"] = np.bincount(ids, weights = intensity[rows, cols], minlength = numLabels)[present] / area
+    return stats
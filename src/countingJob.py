@@ -0,0 +1,70 @@
+"""getCells (or getCellsPaired) running in a background thread."""
+import threading
+
+from count import getCells, getCellsPaired, CountingCancelled
+from resultCache import cached
+
+
+class CountingJob():
+    """Count cells of image in a background thread. The result can be waited for and the job can be cancelled.
+    Used to start counting speculatively as soon as an image is captured. Results of images counted before with the
+    same parameters are taken from the result cache. With uvImage cells are counted by getCellsPaired."""
+    def __init__(self, image, params, progress = None, uvImage = None):
+        """:param np.ndarray image: RGB image, must not be modified while counting
+        :param dict params: counting parameters
+        :param callable progress: see count.Checkpoint. can be set later, last progress is kept in lastProgress
+        :param np.ndarray uvImage: UV image of the same dish, fluorescent flags of cells are kept in fluorescent"""
+        self.image  = image
+        self.uvImage = uvImage
+        self.params = params
+        self.progress = progress
+        self.lastProgress = ("circle", 0.0) # next stage, fraction done
+
+        self.cells = None
+        self.fluorescent = None # list of bool, only with uvImage
+        self.fromCache = False
+        self.error = None
+        self.cancelEvent = threading.Event()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        # exceptions are kept without traceback, it would keep the intermediate images of getCells alive
+        try:
+            if self.uvImage is not None:
+                (cells, self.fluorescent), self.fromCache = cached((self.image, self.uvImage), self.params,
+                    lambda: getCellsPaired(self.image, self.uvImage, self.params, progress = self._progress, cancel = self.cancelEvent))
+            else:
+                cells, self.fromCache = cached((self.image,), self.params,
+                                               lambda: getCells(self.image, self.params, progress = self._progress, cancel = self.cancelEvent))
+            self.cells = [tuple(cell) for cell in cells]
+        except CountingCancelled:
+            pass
+        except Exception as e: # pylint: disable=broad-except
+            self.error = e.with_traceback(None)
+
+    def _progress(self, name, fraction):
+        self.lastProgress = (name, fraction)
+        if self.progress is not None:
+            self.progress(name, fraction)
+
+    def matches(self, image, params):
+        """:return bool: job counts image (same object) alone with params and was not cancelled"""
+        return image is self.image and self.uvImage is None and params == self.params and not self.cancelEvent.is_set()
+
+    def cancel(self):
+        """Stop at next counting stage. result() raises CountingCancelled."""
+        self.cancelEvent.set()
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def result(self):
+        """Wait for counting to finish.
+        :return list: cells as (x, y), see count.getCells"""
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if self.cells is None:
+            raise CountingCancelled()
+        return self.cells
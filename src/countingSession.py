@@ -0,0 +1,71 @@
+"""Counting with memoized intermediate results for interactive parameter changes."""
+from count import countingSettings, findDishCircle, mixChannels, cropMargin, dishBoundingBox, getBackend, \
+                  combineSmoothed, labelStatistics, filterStatistics
+
+
+class CountingSession():
+    """Counts cells in one image. Intermediate results of every stage are kept, so counting again with changed
+    parameters only recomputes the stages depending on them (e.g. changing minArea only refilters the regions)."""
+    def __init__(self, image, circle = None):
+        """:param np.ndarray image: RGB image
+        :param np.ndarray circle: dish circle (row, column, radius). detected if None"""
+        self.image = image
+        self.circle = circle
+        self._stages = {} # name -> (key, result)
+
+    def _stage(self, name, key, compute):
+        """Return result of stage name. compute is only called if key changed since last call.
+        :param tuple key: all parameters the stage depends on (including those of previous stages)"""
+        cached = self._stages.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        result = compute()
+        self._stages[name] = (key, result)
+        return result
+
+    def clear(self):
+        """Drop all intermediate results."""
+        self._stages = {}
+
+    def count(self, params = None, returnLabels = False):
+        """Count cells, same result as count.getCells.
+        :param dict params: counting parameters overwriting countingSettings()
+        :param bool returnLabels: additionally return label image of cropped dish and crop slices
+        :return list: cell centroids as (x, y)"""
+        params  = {**countingSettings(), **(params or {})}
+        compact = params["compactDtype"]
+        backend = getBackend(params)
+
+        keyCircle = (params["circleDetection"],)
+        circle    = self.circle if self.circle is not None else self._stage("circle", keyCircle, lambda: findDishCircle(self.image))
+
+        keyBGdata = keyCircle + (params["additionalCut"], compact)
+        BGdata    = self._stage("BGdata", keyBGdata, lambda: mixChannels(self.image, circle, params["additionalCut"], compact))
+
+        keyCrop = keyBGdata + (cropMargin(params), params["backend"])
+        crop    = self._stage("crop", keyCrop, lambda: dishBoundingBox(BGdata, cropMargin(params)))
+
+        keyImage = keyCrop + (params["imageSigma"],)
+        data2    = self._stage("smoothedImage", keyImage, lambda: backend.smooth(BGdata[crop], params["imageSigma"], compact))
+
+        keyMask  = keyCrop + (params["threshold"],)
+        mask     = self._stage("mask", keyMask, lambda: BGdata[crop] > params["threshold"])
+        distance = self._stage("distance", keyMask, lambda: backend.distanceTransform(mask, compact))
+
+        keyDistance = keyMask + (params["distanceSigma"],)
+        data1       = self._stage("smoothedDistance", keyDistance, lambda: backend.smooth(distance, params["distanceSigma"], compact))
+
+        keyData = keyDistance + keyImage
+        data    = self._stage("data", keyData, lambda: combineSmoothed(data1, data2))
+
+        keyMarkers = keyData + (params["minDistance"],)
+        markers    = self._stage("markers", keyMarkers, lambda: backend.findMarkers(data, mask, params["minDistance"]))
+        labels     = self._stage("labels", keyMarkers, lambda: backend.segment(data, markers, mask))
+        stats      = self._stage("statistics", keyMarkers, lambda: labelStatistics(labels))
+
+        cells = filterStatistics(stats, params)
+        cells = [(int(col + crop[1].start), int(row + crop[0].start)) for row, col in cells]
+
+        if returnLabels:
+            return cells, labels, crop
+        return cells
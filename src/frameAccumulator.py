@@ -0,0 +1,78 @@
+"""Merge bursts of frames into one image with less noise."""
+import numpy as np
+import cv2
+
+
+MERGE_METHODS = ["mean", "median", "hdr"]
+
+# weights of pixel values in "hdr" merge: low for under- and overexposed pixels, never 0 so saturated pixels keep a value
+HDR_WEIGHTS = (np.minimum(np.arange(256), 255 - np.arange(256)) + 1).astype(np.float32)
+
+
+class FrameAccumulator():
+    """Merges frames of same shape as they arrive. Buffers are allocated once.
+    mean:   float32 sum of frames divided by the sum of their exposures
+    median: per pixel median of all frames (kept in a uint8 stack), frames must have same exposure
+    hdr:    per pixel weighted mean of frame / exposure, see HDR_WEIGHTS. used for exposure bracketing
+    The result is scaled to exposure 1."""
+    def __init__(self, shape, method = "mean", numFrames = 1):
+        """:param tuple shape: shape of frames
+        :param str method: one of MERGE_METHODS
+        :param int numFrames: maximal number of frames, only needed for median"""
+        if method not in MERGE_METHODS:
+            raise ValueError(f"Unknown merge method {method}, use one of {MERGE_METHODS}")
+        self.method = method
+        self.numFrames = 0
+        self.exposure  = 0.0 # sum of exposures of added frames
+        if method == "median":
+            self.stack = np.empty((numFrames,) + tuple(shape), dtype = np.uint8)
+        else:
+            self.sum = np.zeros(shape, dtype = np.float32)
+        if method == "hdr":
+            self.weights = np.zeros(shape, dtype = np.float32)
+            self.buffer  = np.empty(shape, dtype = np.float32)
+
+    def add(self, frame, exposure = 1.0):
+        """Add frame. frame can be reused afterwards.
+        :param np.ndarray frame: uint8 image
+        :param float exposure: exposure of frame relative to reference exposure"""
+        if self.method == "mean":
+            cv2.accumulate(frame, self.sum)
+        elif self.method == "median":
+            self.stack[self.numFrames] = frame
+        else:
+            # table lookups instead of float conversions of frame
+            self.sum     += cv2.LUT(frame, HDR_WEIGHTS * np.arange(256, dtype = np.float32) / exposure, dst = self.buffer)
+            self.weights += cv2.LUT(frame, HDR_WEIGHTS, dst = self.buffer)
+        self.numFrames += 1
+        self.exposure  += exposure
+
+    def result(self):
+        """:return np.ndarray: merged uint8 image at exposure 1, values above 255 are clipped"""
+        if self.numFrames == 0:
+            raise ValueError("No frames added")
+        if self.method == "mean":
+            return cv2.convertScaleAbs(self.sum, alpha = 1 / self.exposure)
+        if self.method == "hdr":
+            return cv2.convertScaleAbs(cv2.divide(self.sum, self.weights, dst = self.buffer))
+
+        frames = sortFrames(self.stack[:self.numFrames])
+        middle = self.numFrames // 2
+        exposure = self.exposure / self.numFrames
+        if self.numFrames % 2:
+            return cv2.convertScaleAbs(frames[middle], alpha = 1 / exposure)
+        return cv2.addWeighted(frames[middle - 1], 0.5 / exposure, frames[middle], 0.5 / exposure, 0)
+
+
+def sortFrames(frames):
+    """Sort stack of frames per pixel in place by odd-even transposition (whole frame minimum/maximum operations).
+    For the few frames of a burst much faster than np.sort/np.partition along the strided first axis.
+    :param np.ndarray frames: shape (n, ...)
+    :return np.ndarray: frames"""
+    temp = np.empty_like(frames[0])
+    for sortPass in range(len(frames)):
+        for i in range(sortPass % 2, len(frames) - 1, 2):
+            np.minimum(frames[i], frames[i+1], out = temp)
+            np.maximum(frames[i], frames[i+1], out = frames[i+1])
+            np.copyto(frames[i], temp)
+    return frames
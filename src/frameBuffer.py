@@ -0,0 +1,58 @@
+"""Preallocated frame buffer to pass live frames from the capture thread to the GUI."""
+import time
+import threading
+import numpy as np
+
+
+class FrameBuffer():
+    """Ring of preallocated frames with a single "latest frame" slot.
+    The capture thread writes into a free frame and publishes it as latest frame, an unread older frame is dropped.
+    The frame held by the reader is never written, so it can be displayed without copying.
+    onPublish is called (from the capture thread) when a frame becomes available. It is not called again before the
+    frame was read, so notifications are coalesced if frames arrive faster than they are read."""
+    def __init__(self, shape, numFrames = 3, dtype = np.uint8):
+        # 3 frames: one being written, one latest, one held by reader
+        self.frames = [np.zeros(shape, dtype = dtype) for _ in range(numFrames)]
+        self.timestamps = [0.0] * numFrames # time.perf_counter() of capture of each frame
+        self.onPublish = None
+        self._lock = threading.Condition()
+        self._latest  = None # index of published, unread frame
+        self._reading = None # index of frame held by reader
+
+    def writeFrame(self):
+        """Frame the capture thread may write to. Has to be passed to publish afterwards.
+        Only one writer is supported.
+        :return tuple: index and frame"""
+        with self._lock:
+            for index, frame in enumerate(self.frames):
+                if index not in (self._latest, self._reading):
+                    return index, frame
+        raise RuntimeError("No free frame in FrameBuffer")
+
+    def publish(self, index, timestamp = None):
+        """Make written frame the latest frame.
+        :param float timestamp: capture time (time.perf_counter()), default: now"""
+        with self._lock:
+            notify = self._latest is None
+            self._latest = index
+            self.timestamps[index] = time.perf_counter() if timestamp is None else timestamp
+            self._lock.notify_all()
+        if notify and self.onPublish is not None:
+            self.onPublish()
+
+    def read(self, wait = 0):
+        """Take latest frame. It stays valid (is not overwritten) until the next call of read.
+        :param float wait: seconds to wait for a new frame if there is none
+        :return tuple: index and frame, (None, None) if there is no new frame"""
+        with self._lock:
+            if self._latest is None and wait > 0:
+                self._lock.wait_for(lambda: self._latest is not None, wait)
+            if self._latest is None:
+                return None, None
+            self._reading, self._latest = self._latest, None
+            return self._reading, self.frames[self._reading]
+
+    def clear(self):
+        """Drop unread frame."""
+        with self._lock:
+            self._latest = None
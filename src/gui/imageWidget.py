@@ -1,38 +1,114 @@
+import time
+from collections import deque
 import cv2
 import numpy as np
 
-from PyQt5.QtCore import  QPoint, QTimer
+from PyQt5.QtCore import  Qt, QPoint, pyqtSignal
 from PyQt5.QtWidgets import QWidget
-from PyQt5.QtGui import QPainter, QImage
+from PyQt5.QtGui import QPainter, QImage, QPen, QColor, QFont
 
 import constants
+from logger import logger
+from liveCounter import LiveCounter
+from count import countingSettings
 
 class ImageWidget(QWidget):
     """Widget to dispay image."""
-    def __init__(self, queue, parent=None):
-        super(ImageWidget, self).__init__(parent)
-
-        self.imageQueue = queue
+    frameReadySignal = pyqtSignal() # emitted by capture thread when a new frame is in frameBuffer
+    liveCountSignal  = pyqtSignal(object, float) # emitted by liveCounter thread with cells and seconds
 
-        # Timer to trigger display
-        self.showTimer = QTimer(self)
-        self.showTimer.setInterval(constants.DISP_MSEC)
-        self.showTimer.timeout.connect(self.showQueueImage)
-        self.startShowLive = self.showTimer.start
-        self.stopShowLive  = self.showTimer.stop
+    STATS_INTERVAL = 5 # seconds between display statistics log messages
 
+    def __init__(self, frameBuffer, parent=None):
+        super(ImageWidget, self).__init__(parent)
 
-        self.displayImage   = None
+        self.frameBuffer = frameBuffer
+        self.showLive = False
+
+        # capture thread notifies about new frames, slot runs in gui thread
+        self.frameReadySignal.connect(self.showLatestFrame, Qt.QueuedConnection)
+        self.frameBuffer.onPublish = self.frameReadySignal.emit
+
+        # approximate count of live frames drawn as overlay (settings["Counting"]["liveCount"])
+        self.liveCount   = False
+        self.liveCells   = None # cells of last counted live frame, None if not counted yet
+        self.liveCountTime = 0.0 # seconds needed for last live count
+        self.liveCounter = None # created on first use
+        self.liveCountSignal.connect(self.showLiveCount, Qt.QueuedConnection)
+
+        # display statistics of live frames
+        self.paintTimes     = deque(maxlen = 50)
+        self.paintLatencies = deque(maxlen = 50)
+        self.displayTimestamp = None # capture time of displayed live frame, None if not painted yet or no live frame
+        self.lastStatsLog     = time.perf_counter()
+
+        # QImages wrapping the frames of frameBuffer and the buffer for still images are created once and reused
+        self.frameQImages = [self._wrap(frame) for frame in self.frameBuffer.frames]
+        self.stillImage   = np.zeros(constants.DISPLAY_RESOLUTION + (3,), dtype = np.uint8)
+        self.stillQImage  = self._wrap(self.stillImage)
+
+        self.displayImage   = self.stillImage # image painted, frame of frameBuffer or stillImage
+        self.displayQImage  = self.stillQImage
         self.fullImage      = None
         self.annotatedImage = None
 
-    def showQueueImage(self):
-        """Display image from self.imageQueue to screen"""
-        if self.imageQueue.empty():
+    @staticmethod
+    def _wrap(image):
+        """QImage sharing memory with image of display resolution."""
+        return QImage(image.data, constants.DISPLAY_RESOLUTION[1], constants.DISPLAY_RESOLUTION[0], 3 * constants.DISPLAY_RESOLUTION[1], QImage.Format_RGB888)
+
+    def startShowLive(self):
+        """Show frames of frameBuffer as they arrive."""
+        settings = countingSettings()
+        self.liveCount = settings["liveCount"]
+        self.liveCells = None
+        if self.liveCount:
+            if self.liveCounter is None:
+                self.liveCounter = LiveCounter(self.liveCountSignal.emit)
+            self.liveCounter.interval = max(1, int(settings["liveInterval"]))
+        self.showLive = True
+        self.showLatestFrame()
+
+    def stopShowLive(self):
+        self.showLive = False
+
+    def showLatestFrame(self):
+        """Display latest frame of self.frameBuffer to screen"""
+        if not self.showLive:
+            return
+        index, frame = self.frameBuffer.read()
+        if frame is None:
+            return
+        self.displayImage  = frame
+        self.displayQImage = self.frameQImages[index]
+        self.displayTimestamp = self.frameBuffer.timestamps[index]
+        if self.liveCount:
+            self.liveCounter.submit(frame)
+        self.update()
+
+    def showLiveCount(self, cells, seconds):
+        """Slot for results of liveCounter, overlay is drawn at next paint."""
+        if not self.showLive:
             return
-        self.displayImage = self.imageQueue.get()
-        if self.displayImage is not None and len(self.displayImage) > 0:
-            self.update()
+        self.liveCells = cells
+        self.liveCountTime = seconds
+
+    def displayStats(self):
+        """Statistics of recently painted live frames.
+        :return tuple: frames per second, mean capture to paint latency in ms"""
+        if len(self.paintTimes) < 2:
+            return 0.0, 0.0
+        fps = (len(self.paintTimes) - 1) / (self.paintTimes[-1] - self.paintTimes[0])
+        return fps, 1000 * np.mean(self.paintLatencies)
+
+    def _showStill(self, image, interpolation = cv2.INTER_CUBIC):
+        """Resize image into stillImage and display it.
+        :return np.ndarray: stillImage"""
+        cv2.resize(image, constants.DISPLAY_RESOLUTION[::-1], dst = self.stillImage, interpolation = interpolation)
+        self.displayImage  = self.stillImage
+        self.displayQImage = self.stillQImage
+        self.displayTimestamp = None
+        return self.stillImage
 
     def markCells(self, cells):
         self.annotatedImage = np.copy(self.fullImage)
@@ -47,18 +123,44 @@ class ImageWidget(QWidget):
                     thickness = 10,
                     bottomLeftOrigin = False)
 
-        self.displayImage = cv2.resize(self.annotatedImage, constants.DISPLAY_RESOLUTION[::-1], interpolation=cv2.INTER_CUBIC)
+        self._showStill(self.annotatedImage)
+        self.update()
+
+
+    def markCellsPreview(self, cells):
+        """Show provisional cells on the downscaled full image. annotatedImage is not changed.
+        :param list cells: (x, y) in full image coordinates"""
+        self._showStill(self.fullImage, interpolation = cv2.INTER_AREA)
+        scale = constants.DISPLAY_RESOLUTION[1] / self.fullImage.shape[1]
+        for x, y in cells:
+            cv2.drawMarker(self.displayImage, (int(x*scale), int(y*scale)), (255,255,0), cv2.MARKER_CROSS, thickness = 1, markerSize = 8)
+
+        cv2.putText(self.displayImage,str(len(cells)),
+                    (5, constants.DISPLAY_RESOLUTION[0]-10),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    1.5,
+                    (255,255,0),
+                    thickness = 2,
+                    bottomLeftOrigin = False)
         self.update()
 
 
     def shwoFullImage(self, fullImage):
         self.fullImage = fullImage
 
-        self.displayImage = cv2.resize(self.fullImage, constants.DISPLAY_RESOLUTION[::-1], interpolation=cv2.INTER_CUBIC)
+        self._showStill(self.fullImage)
         self.update()
 
 
 
+    def _paintLiveCount(self, qp):
+        """Draw markers and number of cells of last live count, frame itself is not modified."""
+        qp.setPen(QPen(QColor(255, 255, 0), 1))
+        for x, y in self.liveCells:
+            qp.drawEllipse(QPoint(x, y), 4, 4)
+        qp.setFont(QFont("Sans", 20, QFont.Bold))
+        qp.drawText(5, constants.DISPLAY_RESOLUTION[0] - 10, f"~{len(self.liveCells)}")
+
     def paintEvent(self, event):
         qp = QPainter()
         qp.begin(self)
@@ -67,7 +169,17 @@ class ImageWidget(QWidget):
         if not constants.settings["show"]["Green"]: self.displayImage[:,:,1] = 0
         if not constants.settings["show"]["Blue" ]: self.displayImage[:,:,2] = 0
 
-        if isinstance(self.displayImage, np.ndarray):
-            qImage = QImage(self.displayImage.data, constants.DISPLAY_RESOLUTION[1], constants.DISPLAY_RESOLUTION[0], QImage.Format_RGB888)
-            qp.drawImage(QPoint(0, 0), qImage)
+        qp.drawImage(QPoint(0, 0), self.displayQImage)
+        if self.showLive and self.liveCells is not None:
+            self._paintLiveCount(qp)
         qp.end()
+
+        if self.displayTimestamp is not None:
+            now = time.perf_counter()
+            self.paintTimes    .append(now)
+            self.paintLatencies.append(now - self.displayTimestamp)
+            self.displayTimestamp = None
+            if now - self.lastStatsLog > self.STATS_INTERVAL:
+                self.lastStatsLog = now
+                fps, latency = self.displayStats()
+                logger.info(f"Display: {fps:.1f} fps, capture to paint latency {latency:.0f} ms")
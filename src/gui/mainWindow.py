@@ -1,48 +1,97 @@
 import os
+import copy
+import time
 import queue as Queue
 import threading
 from datetime import datetime
 import numpy as np
-import cv2
 
 from PyQt5.QtCore import Qt
-from PyQt5.QtCore import pyqtSignal, pyqtSlot
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QShortcut, QStackedWidget, QMessageBox, QWidget, QVBoxLayout, QHBoxLayout, QPushButton
+from PyQt5.QtCore import pyqtSignal, pyqtSlot, QTimer
+from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QShortcut, QStackedWidget, QMessageBox, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QProgressBar
 from PyQt5.QtGui import QKeySequence
 
 from logger import logger
-from count import getCells
+import constants
+from count import countingSettings, CountingCancelled
+from countingJob import CountingJob
+from previewCounter import PreviewCounter
+import peakMarkers
 import util
 
 
 from gui.imageWidget import ImageWidget
 from gui.settingsWidget import SettingsWidget
 from hardwareHandler import HardwareHandler
+from frameBuffer import FrameBuffer
+from imageWriter import ImageWriter, saveFormatSettings, writeSidecar, EXTENSIONS
+from profiling import profiler, profilingSettings
 
 
 class MainWindow(QMainWindow):
-    errorSignal          = pyqtSignal(str) #emitted when errors occur. error box with message msg is opened by main thread
-    countingDoneSignal   = pyqtSignal()
-    triggeringDoneSignal = pyqtSignal()
-    backToPreviewSignal  = pyqtSignal()
+    errorSignal                = pyqtSignal(str) #emitted when errors occur. error box with message msg is opened by main thread
+    countingDoneSignal         = pyqtSignal()
+    countingCancelledSignal    = pyqtSignal()
+    countingProgressSignal     = pyqtSignal(str, float) # emitted by counting thread: next stage, fraction done
+    triggeringDoneSignal       = pyqtSignal()
+    backToPreviewSignal        = pyqtSignal()
+    imageSavedSignal           = pyqtSignal(str, float) # emitted by image writer thread: path, seconds
+    imageSaveFailedSignal      = pyqtSignal(str, str)   # path, error message
+    triggerAndSaveStatusSignal = pyqtSignal(int, str)   # step, status
+    stageTimedSignal           = pyqtSignal(str, float) # emitted by profiler (from any thread): stage name, seconds
+    previewCountedSignal       = pyqtSignal(object, object, float) # emitted by previewCounter thread: full image, cells, seconds
+
+    TRIGGER_AND_SAVE_STEPS = ["Capture color Image\t", "Save color Image\t\t", "Capture UV Image\t", "Save UV Image\t\t"]
 
     def __init__(self):
         super(MainWindow, self).__init__()
 
-        self.errorSignal         .connect(self.openErrorMessage)
-        self.countingDoneSignal  .connect(self.countingDone)
-        self.triggeringDoneSignal.connect(self.triggeringDone)
-        self.backToPreviewSignal .connect(self.backToPreview)
+        self.errorSignal               .connect(self.openErrorMessage)
+        self.countingDoneSignal        .connect(self.countingDone)
+        self.countingCancelledSignal   .connect(self.countingCancelled)
+        self.countingProgressSignal    .connect(self.countingProgress)
+        self.triggeringDoneSignal      .connect(self.triggeringDone)
+        self.backToPreviewSignal       .connect(self.backToPreview)
+        self.imageSavedSignal          .connect(self.imageSaved)
+        self.imageSaveFailedSignal     .connect(self.imageSaveFailed)
+        self.triggerAndSaveStatusSignal.connect(self.setTriggerAndSaveStatus)
+        self.stageTimedSignal          .connect(self.showStageTiming)
+        self.previewCountedSignal      .connect(self.showPreviewCount)
 
         self.cellsQueue = Queue.Queue()     # queue to pass cell coordinates found by counting algorithm
-        self.imageQueue = Queue.Queue()     # Queue to hold images
+        self.countingJob = None # CountingJob of imageWidget.fullImage, started by Count or speculatively after trigger
+        self.frameBuffer = FrameBuffer(constants.DISPLAY_RESOLUTION + (3,)) # live frames from capture thread
 
         self.mode = None # "Color" or "UV"
+        self.triggerTime = None # time.perf_counter() of last trigger
+        self.cells          = None # cells found in imageWidget.fullImage, None if not counted
+        self.countingParams = None # counting parameters used to find self.cells
+
+        self.settingsReturnPage = 0     # page shown after settings are closed
+        self.previewCounter     = PreviewCounter(self.previewCountedSignal.emit) # counts settings preview in background
+        self.countingPreviewed  = False # counting settings preview shown since settings were opened
+        # counting settings preview is started once sliders stopped moving
+        self.previewTimer = QTimer(self)
+        self.previewTimer.setSingleShot(True)
+        self.previewTimer.setInterval(constants.PREVIEW_DEBOUNCE_MS)
+        self.previewTimer.timeout.connect(self.previewCounting)
+
+        # images are written in background, results are passed to gui thread by signals
+        self.imageWriter = ImageWriter(onDone = self.imageSavedSignal.emit, onFailed = self.imageSaveFailedSignal.emit)
+        QApplication.instance().aboutToQuit.connect(self.imageWriter.close)
+        self.triggerAndSaveStatus = [""] * len(self.TRIGGER_AND_SAVE_STEPS)
+        self.triggerAndSaveFiles  = {} # path: step in TRIGGER_AND_SAVE_STEPS, for files of trigger and save being written
 
 
         util.loadSettings()
 
-        self.hardwareHandler = HardwareHandler(self.imageQueue)
+        profiler.configure()
+        # compile marker kernel while the user positions the dish
+        threading.Thread(target = peakMarkers.warmUp, daemon = True).start()
+        profiler.listeners.append(self.stageTimedSignal.emit)
+        self.stageTimings = {} # stage name: last seconds, shown in overlay
+
+        self.hardwareHandler = HardwareHandler(self.frameBuffer)
 
 
         #####  shortcuts ####
@@ -69,7 +118,7 @@ class MainWindow(QMainWindow):
         self.hlayout       = QHBoxLayout()
 
         #####  image view #####
-        self.imageWidget = ImageWidget(self.imageQueue, self)
+        self.imageWidget = ImageWidget(self.frameBuffer, self)
         self.hlayout.addWidget(self.imageWidget)
 
         #####  control widget #####
@@ -86,8 +135,7 @@ class MainWindow(QMainWindow):
         buttonTriggerAndSave = QPushButton("Trigger + Save")
         self.buttonMode      = QPushButton("Switch to ...")
         buttonTrigger       .clicked.connect(self.trigger)
-        buttonSettings      .clicked.connect(lambda: self.controlWidget.setCurrentIndex(2))
-        buttonSettings      .clicked.connect(lambda: self.infoTextBox.setText(""))
+        buttonSettings      .clicked.connect(lambda: self.openSettings(returnPage = 0))
         buttonTriggerAndSave.clicked.connect(self.triggerAndSave)
         self.buttonMode     .clicked.connect(lambda: self.changeMode())
         self.page1Layout.addWidget(buttonTrigger)
@@ -105,18 +153,20 @@ class MainWindow(QMainWindow):
         buttonBackToPreview = QPushButton("&Back")
         buttonSaveImage     = QPushButton("&Save")
         buttonCount         = QPushButton("&Count")
+        buttonCountSettings = QPushButton("Count Settings")
         buttonBackToPreview.clicked.connect(self.backToPreview)
         buttonSaveImage    .clicked.connect(lambda: self.saveImage())
         buttonCount        .clicked.connect(self.startCounting)
+        buttonCountSettings.clicked.connect(lambda: self.openSettings(returnPage = 1))
         self.page2Layout.addWidget(buttonBackToPreview)
         self.page2Layout.addWidget(buttonSaveImage)
         self.page2Layout.addWidget(buttonCount)
+        self.page2Layout.addWidget(buttonCountSettings)
 
 
         ## page 3 - settings ##
         self.settingsWidget = SettingsWidget(self.controlWidget)
-        self.settingsWidget.OKButton.clicked.connect(lambda: self.controlWidget.setCurrentIndex(0))
-        self.settingsWidget.OKButton.clicked.connect(lambda: self.infoTextBox.setText("Live capturing"))
+        self.settingsWidget.OKButton.clicked.connect(self.closeSettings)
 
         # signals emitted when settings change
         self.settingsWidget.UVLEDSettingsUpdatedSignal     .connect(self.hardwareHandler.updateLEDUV)
@@ -125,6 +175,10 @@ class MainWindow(QMainWindow):
         self.settingsWidget.resetSignal                    .connect(self.hardwareHandler.updateLEDUV)
         self.settingsWidget.resetSignal                    .connect(self.hardwareHandler.updateLEDColors)
         self.settingsWidget.resetSignal                    .connect(lambda : self.hardwareHandler.updateCaptureSettings(mode = self.mode))
+        self.settingsWidget.countingSettingsUpdatedSignal  .connect(self.previewTimer.start)
+        self.settingsWidget.resetSignal                    .connect(self.previewTimer.start)
+        self.settingsWidget.profilingSettingsUpdatedSignal .connect(self.updateProfiling)
+        self.settingsWidget.resetSignal                    .connect(self.updateProfiling)
 
         #set mode if tab is changed in settings widget
         def setModeFromTabIndex(tabIndex: int):
@@ -132,6 +186,14 @@ class MainWindow(QMainWindow):
             elif tabIndex == 1: self.changeMode("UV")
         self.settingsWidget.tabs.currentChanged.connect(setModeFromTabIndex)
 
+        # show counting preview on count tab, live image otherwise
+        def previewFromTabIndex(tabIndex: int):
+            if self.settingsWidget.tabs.widget(tabIndex) is self.settingsWidget.countTab:
+                self.previewCounting()
+            elif self.settingsReturnPage == 0:
+                self.imageWidget.startShowLive()
+        self.settingsWidget.tabs.currentChanged.connect(previewFromTabIndex)
+
 
 
 
@@ -139,20 +201,20 @@ class MainWindow(QMainWindow):
         self.page4Widget = QWidget(self.controlWidget)
         self.page4Layout = QVBoxLayout(self.page4Widget)
 
-        # buttonStopCounting = QPushButton("&Stop Counting")
-        # buttonStopCounting.clicked.connect(self.stopCounting)
-        # self.page4Layout.addWidget(buttonStopCounting)
-        countingLabel = QLabel("Counting..", alignment = Qt.AlignCenter)
-        self.page4Layout.addWidget(countingLabel)
+        self.buttonStopCounting = QPushButton("&Stop Counting")
+        self.buttonStopCounting.clicked.connect(self.stopCounting)
+        self.countingLabel = QLabel("Counting..", alignment = Qt.AlignCenter)
+        self.countingProgressBar = QProgressBar()
+        self.countingProgressBar.setRange(0, 100)
+        self.page4Layout.addWidget(self.buttonStopCounting)
+        self.page4Layout.addWidget(self.countingLabel)
+        self.page4Layout.addWidget(self.countingProgressBar)
 
 
         ## page 5 - trigger and save ##
         self.page5Widget = QWidget(self.controlWidget)
         self.page5Layout = QVBoxLayout(self.page5Widget)
-        self.triggerAndSaveLabel = QLabel("Capture color Image\t\n"
-                                          "Save color Image\t\t\n"
-                                          "Capture UV Image\t\n"
-                                          "Save UV Image\t\t", alignment = Qt.AlignVCenter | Qt.AlignLeft)
+        self.triggerAndSaveLabel = QLabel("\n".join(self.TRIGGER_AND_SAVE_STEPS), alignment = Qt.AlignVCenter | Qt.AlignLeft)
         self.page5Layout.addWidget(self.triggerAndSaveLabel)
 
 
@@ -177,6 +239,12 @@ class MainWindow(QMainWindow):
         self.infoTextBox.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents) # pylint: disable=no-member
         self.installEventFilter( util.ObjectResizer(self, self.infoTextBox))
 
+        ## stage timings in right top corner (settings["Profiling"]["overlay"])
+        self.profileTextBox = QLabel(self.centralWidget)
+        self.profileTextBox.setAlignment(Qt.AlignRight | Qt.AlignTop)
+        self.profileTextBox.setAttribute(Qt.WidgetAttribute.WA_TransparentForMouseEvents) # pylint: disable=no-member
+        self.installEventFilter( util.ObjectResizer(self, self.profileTextBox))
+
 
         logger.info("Gui started")
         # start capture and led
@@ -229,11 +297,15 @@ class MainWindow(QMainWindow):
         self.page1Widget.setEnabled(False)
         logger.info("Fetching image")
         self.infoTextBox.setText("Fetching image")
+        self.triggerTime = time.perf_counter()
         self.imageWidget.stopShowLive()
-        self.hardwareHandler.stopCapturing()
+        # full resolution stream keeps running, latest frame is taken
+        if not self.hardwareHandler.streamingFullResolution:
+            self.hardwareHandler.stopCapturing()
 
         def run():
             fullImage = self.hardwareHandler.shootImage_fullResolution(mode = self.mode)
+            logger.info(f"Trigger latency: {(time.perf_counter() - self.triggerTime) * 1000:.0f} ms")
             self.imageWidget.shwoFullImage(fullImage)
             self.triggeringDoneSignal.emit()
 
@@ -244,100 +316,233 @@ class MainWindow(QMainWindow):
         self.controlWidget.setCurrentIndex(1)
         self.page1Widget.setEnabled(True)
         self.infoTextBox.setText("Ready")
+        # count in background, result is used if Count is pressed
+        if countingSettings()["precount"]:
+            self.countingJob = CountingJob(self.imageWidget.fullImage, countingSettings())
 
     def backToPreview(self):
         self.infoTextBox.setText("Live capturing")
         self.controlWidget.setCurrentIndex(0)
 
         self.imageWidget.annotatedImage = None
-        self.hardwareHandler.startCapturing(mode = self.mode)
+        self.cells = None
+        if self.countingJob is not None:
+            self.countingJob.cancel()
+            self.countingJob = None
+        if not self.hardwareHandler.capture:
+            self.hardwareHandler.startCapturing(mode = self.mode)
         self.imageWidget.startShowLive()
 
     def triggerAndSave(self):
+        """Capture color and UV image. Images are written by self.imageWriter while the next image is captured.
+        With settings["Counting"]["countPairs"] both images are counted together afterwards, see countPair."""
         def run():
+            startTime = time.perf_counter()
             #stop captureing
             self.imageWidget.stopShowLive()
             self.hardwareHandler.stopCapturing()
             #set gui info
             self.controlWidget.setCurrentIndex(4)
-            self.triggerAndSaveLabel.setText("Capture color Image\t\n"
-                                             "Save color Image\t\t\n"
-                                             "Capture UV Image\t\n"
-                                             "Save UV Image\t\t")
+            for step in range(len(self.TRIGGER_AND_SAVE_STEPS)):
+                self.triggerAndSaveStatusSignal.emit(step, "")
             # use timestamp for file names
             timeStamp = datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
-
-            ########## color image ##########
-            # set color leds
-            self.hardwareHandler.switchCOLOR_LED(True)
-            self.hardwareHandler.switchUV_LED   (False)
-            #capture image
-            fullImage = self.hardwareHandler.shootImage_fullResolution(mode = "Color")
-            #show image
-            self.imageWidget.shwoFullImage(fullImage)
-            self.triggerAndSaveLabel.setText("Capture color Image\t-> done\n"
-                                             "Save color Image\t\t\n"
-                                             "Capture UV Image\t\n"
-                                             "Save UV Image\t\t")
-            self.saveImage(fileName=f"{timeStamp}_color")
-            self.triggerAndSaveLabel.setText("Capture color Image\t-> done\n"
-                                             "Save color Image\t\t-> done\n"
-                                             "Capture UV Image\t\n"
-                                             "Save UV Image\t\t")
-            ########## UV image ##########
-            # set UV leds
-            self.hardwareHandler.switchCOLOR_LED(False)
-            self.hardwareHandler.switchUV_LED   (True)
-            #capture image
-            fullImage = self.hardwareHandler.shootImage_fullResolution(mode = "UV")
-            #show image
-            self.imageWidget.shwoFullImage(fullImage)
-            self.triggerAndSaveLabel.setText("Capture color Image\t-> done\n"
-                                             "Save color Image\t\t-> done\n"
-                                             "Capture UV Image\t-> done\n"
-                                             "Save UV Image\t\t")
-            self.saveImage(fileName=f"{timeStamp}_UV")
-            self.triggerAndSaveLabel.setText("Capture color Image\t-> done\n"
-                                             "Save color Image\t\t-> done\n"
-                                             "Capture UV Image\t-> done\n"
-                                             "Save UV Image\t\t")
+            images = {}
+
+            for step, mode in [(0, "Color"), (2, "UV")]:
+                # set leds
+                self.hardwareHandler.switchCOLOR_LED(mode == "Color")
+                self.hardwareHandler.switchUV_LED   (mode == "UV")
+                #capture image
+                fullImage = self.hardwareHandler.shootImage_fullResolution(mode = mode)
+                images[mode] = fullImage
+                #show image
+                self.imageWidget.shwoFullImage(fullImage)
+                self.triggerAndSaveStatusSignal.emit(step, "-> done")
+                # written in background, next image is captured meanwhile. registered before queuing, writing may finish at once
+                def queued(path, step = step + 1):
+                    self.triggerAndSaveFiles[path] = step
+                    self.triggerAndSaveStatusSignal.emit(step, "-> writing")
+                self.saveImage(fileName = f"{timeStamp}_{'color' if mode == 'Color' else mode}", mode = mode, onQueued = queued)
+
+            logger.info(f"Trigger + Save: images captured after {time.perf_counter() - startTime:.1f} s")
             self.backToPreviewSignal.emit()
+            if countingSettings()["countPairs"]:
+                self.countPair(images["Color"], images["UV"], timeStamp)
 
         thread = threading.Thread(target = run)
         thread.start()
 
+    def countPair(self, image, uvImage, fileName):
+        """Count cells of color image, classify them as fluorescent by uvImage (count.getCellsPaired) and write the
+        result to <fileName>_paired.json on the usb device. Blocks until counted, called from trigger and save thread."""
+        params = countingSettings()
+        try:
+            job = CountingJob(image, params, uvImage = uvImage)
+            cells = job.result()
+            path = writeSidecar(os.path.join(util.getUsbDevicePath(), fileName + "_paired"),
+                                {"count": len(cells), "fluorescentCount": sum(job.fluorescent),
+                                 "cells": [[int(x), int(y)] for x, y in cells], # (x, y) in image coordinates
+                                 "fluorescent": job.fluorescent, "countingSettings": params})
+        except IndexError:
+            self.errorSignal.emit("No USB device found - paired count was not saved")
+            return
+        except Exception as e: # pylint: disable=broad-except
+            self.errorSignal.emit(f"Paired counting failed: {e}")
+            return
+        logger.info(f"Paired count: {len(cells)} cells, {sum(job.fluorescent)} fluorescent, written to {path}")
+
+    @pyqtSlot(int, str)
+    def setTriggerAndSaveStatus(self, step, status):
+        """Update status of step in TRIGGER_AND_SAVE_STEPS shown on page 5.
+        :param int step: index in TRIGGER_AND_SAVE_STEPS
+        :param str status: appended to step, e.g. '-> done'"""
+        self.triggerAndSaveStatus[step] = status
+        self.triggerAndSaveLabel.setText("\n".join(name + status for name, status in zip(self.TRIGGER_AND_SAVE_STEPS, self.triggerAndSaveStatus)))
+
+    def openSettings(self, returnPage = 0):
+        """Show settings page.
+        :param int returnPage: page shown when settings are closed. capture settings can only be changed from live page (0)"""
+        self.settingsReturnPage = returnPage
+        self.countingPreviewed  = False
+        # changing the mode would restart live capturing
+        if returnPage != 0:
+            self.settingsWidget.tabs.setCurrentWidget(self.settingsWidget.countTab)
+        self.settingsWidget.tabs.setTabEnabled(0, returnPage == 0)
+        self.settingsWidget.tabs.setTabEnabled(1, returnPage == 0)
+
+        self.infoTextBox.setText("")
+        self.controlWidget.setCurrentIndex(2)
+        # detect dish circle of image once, while settings are shown
+        if self.imageWidget.fullImage is not None:
+            self.previewCounter.setImage(self.imageWidget.fullImage)
+        self.previewCounting()
+
+    def closeSettings(self):
+        """Return to page settings were opened from. Count full image if counting settings were previewed on it."""
+        self.previewTimer.stop()
+        self.settingsWidget.tabs.setTabEnabled(0, True)
+        self.settingsWidget.tabs.setTabEnabled(1, True)
+        if self.settingsReturnPage == 1:
+            self.controlWidget.setCurrentIndex(1)
+            if self.countingPreviewed:
+                self.startCounting()
+            else:
+                self.imageWidget.shwoFullImage(self.imageWidget.fullImage)
+                self.infoTextBox.setText("Ready")
+        else:
+            self.controlWidget.setCurrentIndex(0)
+            self.imageWidget.startShowLive()
+            self.infoTextBox.setText("Live capturing")
+        self.countingPreviewed = False
+
+    def previewShown(self):
+        """:return bool: count settings are shown"""
+        return self.controlWidget.currentIndex() == 2 and self.settingsWidget.tabs.currentWidget() is self.settingsWidget.countTab
+
+    def previewCounting(self):
+        """Count on downscaled copy of full image in background, provisional cells are shown by showPreviewCount.
+        Only while count settings are shown."""
+        if not self.previewShown():
+            return
+        if self.imageWidget.fullImage is None:
+            self.infoTextBox.setText("No image for preview")
+            return
+        self.imageWidget.stopShowLive()
+        self.previewCounter.submit(self.imageWidget.fullImage)
+        self.countingPreviewed = True
+
+    @pyqtSlot(object, object, float)
+    def showPreviewCount(self, image, cells, seconds):
+        """Slot for results of previewCounter. Results of images not shown anymore are dropped."""
+        if not self.previewShown() or image is not self.imageWidget.fullImage:
+            return
+        self.imageWidget.markCellsPreview(cells)
+        self.infoTextBox.setText(f"Preview: {len(cells)} cells ({seconds*1000:.0f} ms)")
+
     def startCounting(self):
         logger.info("Counting...")
         self.infoTextBox.setText("Counting...")
 
-        self.countingThread = threading.Thread(target = self.count)
+        self.countingLabel.setText("Counting..")
+        self.countingProgressBar.setValue(0)
+        self.buttonStopCounting.setEnabled(True)
+
+        # reuse job started after trigger if image and parameters did not change
+        params = countingSettings()
+        if self.countingJob is None or not self.countingJob.matches(self.imageWidget.fullImage, params):
+            if self.countingJob is not None:
+                self.countingJob.cancel()
+            self.countingJob = CountingJob(self.imageWidget.fullImage, params)
+        self.countingJob.progress = self.countingProgressSignal.emit
+        self.countingProgress(*self.countingJob.lastProgress)
+
+        self.countingThread = threading.Thread(target = self.count, args = (self.countingJob,))
         self.countingThread.start()
 
         self.controlWidget.setCurrentIndex(3)
 
-    # def stopCounting(self):
-    #     logger.info("Counting stopped")
-    #     self.infoTextBox.setText("Counting stopped")
-    #     self.controlWidget.setCurrentIndex(1)
-
+    def stopCounting(self):
+        """Counting thread stops before next stage. Nothing to stop if the job is already done (result is shown)."""
+        self.buttonStopCounting.setEnabled(False)
+        if self.countingJob.done():
+            return
+        logger.info("Stopping counting")
+        self.infoTextBox.setText("Stopping counting")
+        self.countingJob.cancel()
+
+    @pyqtSlot(str, float)
+    def countingProgress(self, name, fraction):
+        self.countingLabel.setText(f"Counting..\n{name}")
+        self.countingProgressBar.setValue(int(100 * fraction))
+
+    def countingCancelled(self):
+        logger.info("Counting stopped")
+        self.infoTextBox.setText("Counting stopped")
+        self.controlWidget.setCurrentIndex(1)
 
     def countingDone(self):
         logger.info("Counting done")
         self.infoTextBox.setText("Counting done")
 
-        cells = self.cellsQueue.get()
+        cells, self.countingParams = self.cellsQueue.get()
+        self.cells = cells
         logger.info(f"{len(cells)} cells found")
 
         self.imageWidget.markCells(cells)
         self.controlWidget.setCurrentIndex(1)
 
 
-    def count(self):
-        cells = getCells(self.imageWidget.fullImage)
-        self.cellsQueue.put(cells)
+    def count(self, job):
+        """Wait for result of CountingJob."""
+        try:
+            cells = job.result()
+        except CountingCancelled:
+            self.countingCancelledSignal.emit()
+            return
+        except Exception as e: # pylint: disable=broad-except
+            self.errorSignal.emit(f"Counting failed: {e}")
+            self.countingCancelledSignal.emit()
+            return
+        self.cellsQueue.put((cells, job.params))
         self.countingDoneSignal.emit()
 
 
+    def updateProfiling(self):
+        """Apply settings["Profiling"] changed in settings widget. Overlay is cleared if it was switched off."""
+        profiler.configure()
+        if not profilingSettings()["overlay"]:
+            self.stageTimings = {}
+            self.profileTextBox.setText("")
+
+    @pyqtSlot(str, float)
+    def showStageTiming(self, name, seconds):
+        """Show last timing of every stage in overlay."""
+        if not profilingSettings()["overlay"]:
+            return
+        self.stageTimings[name] = seconds
+        self.profileTextBox.setText("\n".join(f"{stageName}: {stageSeconds * 1000:.0f} ms" for stageName, stageSeconds in self.stageTimings.items()))
+
     @pyqtSlot(str)
     def openErrorMessage(self, msg):
         logger.fatal(msg)
@@ -348,23 +553,47 @@ class MainWindow(QMainWindow):
         msgBox.exec_()
 
 
-    def saveImage(self, fileName = None):
-        """save image to usb file. default file name is timestamp
-        :param str fileName: ending .tiff is added automatically"""
-        self.infoTextBox.setText("Saving image")
-        self.page2Widget.setEnabled(False)
+    def saveImage(self, fileName = None, mode = None, onQueued = None):
+        """Queue image for writing to usb device in format of settings["Save"]. default file name is timestamp.
+        Cells and settings are written to a json sidecar, the annotated image only if settings["Save"]["annotatedImage"].
+        :param str fileName: file ending is added automatically
+        :param str mode: "Color" or "UV" mode image was captured in, default self.mode
+        :param callable onQueued: see ImageWriter.submit
+        :return list: queued image file paths, empty if no usb device was found"""
         try:
             usbPath = util.getUsbDevicePath()
         except IndexError:
-            self.page2Widget.setEnabled(True)
             self.infoTextBox.setText("Saving failed")
             self.errorSignal.emit("No USB device found - file was not saved")
-            return
+            return []
         if fileName is None:
             fileName = datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
-        cv2.imwrite(os.path.join(usbPath, fileName + ".tiff"), cv2.cvtColor(self.imageWidget.fullImage     , cv2.COLOR_RGB2BGR))
-        if isinstance(self.imageWidget.annotatedImage, np.ndarray):
-            cv2.imwrite(os.path.join(usbPath, fileName + "_annotated.tiff"), cv2.cvtColor(self.imageWidget.annotatedImage, cv2.COLOR_RGB2BGR))
-        logger.info("Saved File to " + usbPath)
-        self.page2Widget.setEnabled(True)
-        self.infoTextBox.setText("Image saved")
+        self.infoTextBox.setText("Saving image")
+        path = os.path.join(usbPath, fileName)
+        options = saveFormatSettings()
+
+        sidecar = {"image": fileName + EXTENSIONS[options["format"]], "mode": mode or self.mode, "settings": copy.deepcopy(constants.settings)}
+        if self.cells is not None:
+            sidecar["count"] = len(self.cells)
+            sidecar["cells"] = [[int(x), int(y)] for x, y in self.cells] # (x, y) in image coordinates
+            sidecar["countingSettings"] = self.countingParams
+
+        paths = [self.imageWriter.submit(path, self.imageWidget.fullImage, sidecar, options, onQueued)]
+        if options["annotatedImage"] and isinstance(self.imageWidget.annotatedImage, np.ndarray):
+            paths.append(self.imageWriter.submit(path + "_annotated", self.imageWidget.annotatedImage, options = options, onQueued = onQueued))
+        return paths
+
+    @pyqtSlot(str, float)
+    def imageSaved(self, path, seconds):
+        logger.info(f"Saved {path} ({seconds:.1f} s)")
+        if path in self.triggerAndSaveFiles:
+            self.setTriggerAndSaveStatus(self.triggerAndSaveFiles.pop(path), "-> done")
+        if self.imageWriter.pending() == 0 and self.controlWidget.currentIndex() == 1:
+            self.infoTextBox.setText("Image saved")
+
+    @pyqtSlot(str, str)
+    def imageSaveFailed(self, path, msg):
+        if path in self.triggerAndSaveFiles:
+            self.setTriggerAndSaveStatus(self.triggerAndSaveFiles.pop(path), "-> failed")
+        self.infoTextBox.setText("Saving failed")
+        self.errorSignal.emit(f"Saving {path} failed: {msg}")
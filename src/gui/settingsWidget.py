@@ -5,6 +5,8 @@ from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QGridLayout, QPus
 import constants
 
 import util
+from count import countingSettings
+from profiling import profilingSettings
 
 
 
@@ -14,6 +16,8 @@ class SettingsWidget(QWidget):
     ColorLEDSettingsUpdatedSignal = pyqtSignal()
     showSettingsUpdatedSignal     = pyqtSignal()
     captureSettingsUpdatedSignal  = pyqtSignal(str)
+    countingSettingsUpdatedSignal = pyqtSignal()
+    profilingSettingsUpdatedSignal= pyqtSignal()
     resetSignal                   = pyqtSignal()
 
     def __init__(self, parent = None):
@@ -51,7 +55,7 @@ class SettingsWidget(QWidget):
 
         ###################### tabs ################
         self.tabs = QTabWidget(self)
-        self.tabs.setStyleSheet(f"QTabWidget::tab-bar {{alignment: center;}} .QTabBar::tab {{height: 50px; width: {int(320/3)}px;}}")
+        self.tabs.setStyleSheet(f"QTabWidget::tab-bar {{alignment: center;}} .QTabBar::tab {{height: 50px; width: {int(320/4)}px;}}")
 
         #######--------> Color <--------#######
         self.ColorTab = QWidget(self.tabs)
@@ -150,8 +154,54 @@ class SettingsWidget(QWidget):
             self.showLayout.addWidget(widget)
             self.showColorCheckboxes[name] = checkbox
 
+        # settings["Profiling"]
+        self.profilingCheckboxes = {}
+        profiling = profilingSettings()
+        for name, text in [("enabled", "Profiling"), ("overlay", "Show timings")]:
+            widget = QWidget(self.showTab)
+            layout = QHBoxLayout(widget)
+            layout.setContentsMargins(0,0,0,0)
+            layout.addWidget(QLabel(text, widget))
+
+            checkbox = QCheckBox(widget)
+            checkbox.setChecked(profiling[name])
+            checkbox.setStyleSheet("QCheckBox::indicator { width:50px; height: 50px;}")
+            checkbox.stateChanged.connect(self.updateProfiling)
+            layout.addWidget(checkbox)
+
+            self.showLayout.addWidget(widget)
+            self.profilingCheckboxes[name] = checkbox
+
         self.showLayout.addStretch()
 
+        #######--------> Count <--------#######
+        self.countTab = QWidget(self.tabs)
+        self.tabs.addTab(self.countTab, "Count")
+        self.countLayout = QGridLayout(self.countTab)
+
+        self.countSliders = {}
+        self.countLabels  = {}
+        counting = countingSettings()
+        # name in settings, label, min, max, interval. two rows of sliders
+        for i, (name, short, minValue, maxValue, interval) in enumerate([("threshold"    , "Thr"  , 0    , 500   , 5   ),
+                                                                         ("minArea"      , "Amin" , 0    , 10000 , 100 ),
+                                                                         ("maxArea"      , "Amax" , 10000, 200000, 5000),
+                                                                         ("maxAxisRatio" , "Ratio", 1    , 10    , 1   ),
+                                                                         ("minDistance"  , "Dist" , 1    , 50    , 1   ),
+                                                                         ("distanceSigma", "SigD" , 1    , 20    , 1   ),
+                                                                         ("imageSigma"   , "SigI" , 1    , 20    , 1   )]):
+            slid  = util.IntervalSlider(Qt.Vertical, minValue = minValue, maxValue = maxValue, interval = interval)
+            slid.setValue(counting[name])
+            slid.valueChanged.connect(self.updateCounting)
+
+            label = QLabel(f"{short}\n{slid.value()}"  , alignment = Qt.AlignCenter)
+
+            self.countLayout.addWidget(label, 2*(i//4)    , i%4)
+            self.countLayout.addWidget(slid , 2*(i//4) + 1, i%4)
+
+            self.countSliders[name] = slid
+            self.countLabels [name] = (label, short)
+
         #@TODO move up
         self.mainLayout.addWidget(self.tabs)
         self.mainLayout.addWidget(self.buttonsWidget)
@@ -181,6 +231,16 @@ class SettingsWidget(QWidget):
         for name, checkbox in self.showColorCheckboxes.items():
             checkbox.setChecked(constants.settings["show"][name])
 
+        profiling = profilingSettings()
+        for name, checkbox in self.profilingCheckboxes.items():
+            checkbox.setChecked(profiling[name])
+
+        counting = countingSettings()
+        for name, slid in self.countSliders.items():
+            slid.setValue(counting[name])
+            label, short = self.countLabels[name]
+            label.setText(f"{short}\n{counting[name]}")
+
         # self.blockSignals(False)
         self.resetting = False
         self.resetSignal.emit()
@@ -211,3 +271,21 @@ class SettingsWidget(QWidget):
         for name, checkbox in self.showColorCheckboxes.items():
             constants.settings["show"][name] = checkbox.isChecked()
         self.showSettingsUpdatedSignal.emit()
+
+    def updateProfiling(self):
+        """Profiling enabled or timings overlay updated"""
+        if self.resetting: return
+        profiling = constants.settings.setdefault("Profiling", {})
+        for name, checkbox in self.profilingCheckboxes.items():
+            profiling[name] = checkbox.isChecked()
+        self.profilingSettingsUpdatedSignal.emit()
+
+    def updateCounting(self):
+        """Counting parameters updated"""
+        if self.resetting: return
+        counting = constants.settings.setdefault("Counting", {})
+        for name, slid in self.countSliders.items():
+            counting[name] = slid.value()
+            label, short = self.countLabels[name]
+            label.setText(f"{short}\n{counting[name]}")
+        self.countingSettingsUpdatedSignal.emit()
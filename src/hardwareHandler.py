@@ -2,11 +2,15 @@
 import time
 import os
 import threading
-import subprocess
+import numpy as np
 import cv2
 
 import constants
 from logger import logger
+from cameraControl import CameraControl, V4L2Backend, FakeBackend
+from frameBuffer import FrameBuffer
+from frameAccumulator import FrameAccumulator
+from profiling import timed
 
 if os.uname().nodename == "raspberrypi":
     import RPi.GPIO as GPIO
@@ -20,14 +24,37 @@ else:
 
 
 
+def captureSettings():
+    """Return capture settings from constants.settings. Missing values are taken from constants.CAPTURE_DEFAULTS."""
+    return {**constants.CAPTURE_DEFAULTS, **constants.settings.get("Capture", {})}
+
+
+def burstSettings(mode):
+    """Return burst settings of mode ("Color" or "UV") from constants.settings. Missing values are taken from constants.BURST_DEFAULTS."""
+    return {key: constants.settings.get(mode, {}).get(key, default) for key, default in constants.BURST_DEFAULTS.items()}
+
+
+def burstExposures(settings):
+    """Exposures of the frames of a burst relative to exposureTime.
+    :param dict settings: see burstSettings
+    :return list: one exposure per frame, [1.0] for a single frame"""
+    frames = max(1, int(settings["burstFrames"]))
+    if settings["burstMerge"] == "hdr":
+        return [float(exposure) for exposure in settings["hdrExposures"] for _ in range(frames)]
+    return [float(settings["burstExposure"])] * frames
+
+
 class HardwareHandler():
     """Class to handle LEDs and camera."""
-    def __init__(self, imageQueue):
+    def __init__(self, frameBuffer):
 
-        self.imageQueue = imageQueue
+        self.frameBuffer = frameBuffer
+        self.fullFrameBuffer = None # full resolution frames, only allocated if streaming full resolution
         self.capture = False
+        self.streamingFullResolution = False
         self.capture_thread = None
         self.cap = cv2.VideoCapture(constants.CAMERA_NUM-1 + cv2.CAP_ANY)
+        self.cameraControl = CameraControl(self.cap, FakeBackend() if testMode else V4L2Backend(constants.CAMERA_DEVICE))
 
         self.UV_LED    = False
         self.COLOR_LED = False
@@ -111,34 +138,74 @@ class HardwareHandler():
 ###################### Camera ######################
 
     def startCapturing(self, mode = "Color"):
-        """ Start image capture & display """
+        """ Start image capture & display.
+        If settings["Capture"]["fullResolutionStream"] the camera streams at full resolution and
+        shootImage_fullResolution takes the latest frame instead of switching the resolution."""
         self.capture = True
-        def grab_images(queue):
-            self.setCaptureSettings(mode, "low")
+        self.streamingFullResolution = captureSettings()["fullResolutionStream"]
+        if self.streamingFullResolution and self.fullFrameBuffer is None:
+            self.fullFrameBuffer = FrameBuffer(constants.CAMERA_RESOLUTION + (3,))
+        def grab_images(frameBuffer):
+            self.setCaptureSettings(mode, "full" if self.streamingFullResolution else "low")
+            # buffers are reused for every frame
+            image   = None
+            resized = np.empty(constants.DISPLAY_RESOLUTION + (3,), dtype = np.uint8)
             while self.capture:
+                if self.streamingFullResolution:
+                    # retrieve directly into full resolution frame buffer
+                    index, image = self.fullFrameBuffer.writeFrame()
                 if self.cap.grab():
-                    _ , image = self.cap.retrieve(0)
-                    if image is not None and queue.qsize() < 2:
-                        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                        image = cv2.resize  (image, constants.DISPLAY_RESOLUTION[::-1], interpolation=cv2.INTER_CUBIC)
-                        queue.put(image)
-                    else:
+                    captureTime = time.perf_counter()
+                    _ , retrieved = self.cap.retrieve(image)
+                    if retrieved is None:
                         time.sleep(constants.DISP_MSEC / 1000.0)
+                        continue
+                    if self.streamingFullResolution:
+                        if retrieved is not image:
+                            image[...] = retrieved
+                        self.fullFrameBuffer.publish(index, captureTime)
+                        self._toDisplayFrame(image, resized, frameBuffer, captureTime, cv2.INTER_AREA)
+                    else:
+                        image = retrieved
+                        self._toDisplayFrame(image, resized, frameBuffer, captureTime)
                 else:
                     logger.fatal("Can't grab camera image")
                     logger.fatal("Using test image instead")
                     image = cv2.imread(constants.TEST_IMAGE_NAME)
-                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-                    image = cv2.resize  (image, constants.DISPLAY_RESOLUTION[::-1], interpolation=cv2.INTER_CUBIC)
-                    queue.put(image)
+                    if self.streamingFullResolution:
+                        index, frame = self.fullFrameBuffer.writeFrame()
+                        frame[...] = image
+                        self.fullFrameBuffer.publish(index)
+                    self._toDisplayFrame(image, resized, frameBuffer)
                     break
 
-        self.capture_thread = threading.Thread(target = grab_images, args   = (self.imageQueue,)) # Thread to grab images
+        self.capture_thread = threading.Thread(target = grab_images, args   = (self.frameBuffer,)) # Thread to grab images
         self.capture_thread.start()
 
+    @staticmethod
+    def _toDisplayFrame(image, resized, frameBuffer, captureTime = None, interpolation = cv2.INTER_CUBIC):
+        """Resize BGR image to display resolution, convert to RGB and publish it without allocating new arrays."""
+        index, frame = frameBuffer.writeFrame()
+        cv2.resize  (image, constants.DISPLAY_RESOLUTION[::-1], dst = resized, interpolation = interpolation)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst = frame)
+        frameBuffer.publish(index, captureTime)
+
+    @timed("shootImage_fullResolution")
     def shootImage_fullResolution(self, mode = "Color"):
-        """Shoot single image with maximal camera resolution
+        """Shoot single image with maximal camera resolution. If a burst is set in settings[mode] (see burstSettings)
+        several frames are merged by shootBurst_fullResolution instead.
         :return np.ndarray: image """
+        settings = burstSettings(mode)
+        if burstExposures(settings) != [1.0]:
+            return self.shootBurst_fullResolution(mode, settings)
+
+        if self.capture and self.streamingFullResolution:
+            fullImage = self.snapshot()
+            if fullImage is not None:
+                return fullImage
+            logger.warn("No frame from full resolution stream, capturing single image")
+            self.stopCapturing()
+
         self.setCaptureSettings(mode, "full")
         if self.cap.grab():
             _ , fullImage = self.cap.retrieve(0)
@@ -151,12 +218,76 @@ class HardwareHandler():
 
         return fullImage
 
+    def shootBurst_fullResolution(self, mode = "Color", settings = None):
+        """Shoot a burst of frames with maximal camera resolution, optionally at different exposures, and merge them
+        with FrameAccumulator. Frames are merged while the next one is exposed.
+        The full resolution stream is used if no exposure change is needed.
+        :param dict settings: burst settings, default burstSettings(mode)
+        :return np.ndarray: merged RGB image"""
+        settings = settings or burstSettings(mode)
+        exposures = burstExposures(settings)
+        exposureTime = constants.settings[mode]["exposureTime"]
+        if exposureTime == 0 and any(exposure != 1 for exposure in exposures):
+            logger.warn("Burst exposures are ignored with auto exposure (exposureTime 0)")
+            exposures = [1.0] * len(exposures)
+        startTime = time.perf_counter()
+
+        accumulator = FrameAccumulator(constants.CAMERA_RESOLUTION + (3,), settings["burstMerge"], len(exposures))
+        if self.capture and self.streamingFullResolution and all(exposure == 1 for exposure in exposures):
+            for _ in exposures:
+                # frame stays valid until next read
+                _, frame = self.fullFrameBuffer.read(wait = constants.SNAPSHOT_TIMEOUT)
+                if frame is None:
+                    break
+                accumulator.add(frame)
+        if accumulator.numFrames < len(exposures):
+            if self.capture:
+                self.stopCapturing()
+            accumulator = FrameAccumulator(constants.CAMERA_RESOLUTION + (3,), settings["burstMerge"], len(exposures))
+            self._grabBurst(mode, exposures, exposureTime, accumulator)
+
+        logger.info(f"Burst: {accumulator.numFrames} frames merged ({settings['burstMerge']}) in {(time.perf_counter() - startTime) * 1000:.0f} ms")
+        return cv2.cvtColor(accumulator.result(), cv2.COLOR_BGR2RGB)
+
+    def _grabBurst(self, mode, exposures, exposureTime, accumulator):
+        """Grab one frame per exposure into accumulator. Camera is set to full resolution."""
+        frame = None     # retrieve buffer, reused for every frame
+        testImage = None
+        lastExposure = None
+        for exposure in exposures:
+            if exposure != lastExposure:
+                self.setCaptureSettings(mode, "full", exposureTime * exposure if exposureTime != 0 else None)
+                if lastExposure is not None:
+                    for _ in range(constants.EXPOSURE_SETTLE_FRAMES):
+                        self.cap.grab()
+                lastExposure = exposure
+            if self.cap.grab():
+                _ , frame = self.cap.retrieve(frame)
+                accumulator.add(frame, exposure)
+            else:
+                if testImage is None:
+                    logger.fatal("Can't grab camera image")
+                    logger.fatal("Using test image instead")
+                    testImage = cv2.imread(constants.TEST_IMAGE_NAME)
+                accumulator.add(testImage, exposure)
+
+    def snapshot(self):
+        """Copy of latest frame of the full resolution stream.
+        :return np.ndarray: RGB image, None if no new frame arrived within constants.SNAPSHOT_TIMEOUT"""
+        _, frame = self.fullFrameBuffer.read(wait = constants.SNAPSHOT_TIMEOUT)
+        if frame is None:
+            return None
+        # frame stays valid until next read, copy is done by cvtColor
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
     def stopCapturing(self):
         """Stop if capturing."""
         if self.capture:
             self.capture = False
             self.capture_thread.join()
-        self.imageQueue.queue.clear()
+        self.frameBuffer.clear()
+        if self.fullFrameBuffer is not None:
+            self.fullFrameBuffer.clear()
 
     def updateCaptureSettings(self, mode = "Color"):
         """Stop capturing and start again with new settings"""
@@ -164,30 +295,47 @@ class HardwareHandler():
         self.startCapturing(mode = mode)
 
     def __del__(self):
+        self.cameraControl.close()
         if not testMode: GPIO.cleanup()
 
-    def setCaptureSettings(self, LEDMmode, resolution):
-        """Call cv2.VideoCapture and set settings."""
+    @timed("setCaptureSettings")
+    def setCaptureSettings(self, LEDMmode, resolution, exposureTime = None):
+        """Set cv2.VideoCapture properties and camera controls. Only changed values are sent to the camera.
+        :param float exposureTime: overrides settings[LEDMmode]["exposureTime"], used for bursts"""
+        startTime = time.perf_counter()
+        if exposureTime is None:
+            exposureTime = constants.settings[LEDMmode]["exposureTime"]
 
         #set fps dynamic to exposure
         fps = 20
-        if constants.settings[LEDMmode]["exposureTime"] != 0:
-            fps = int(max(1, min(20, 10000 / constants.settings[LEDMmode]["exposureTime"])))
-        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if exposureTime != 0:
+            fps = int(max(1, min(20, 10000 / exposureTime)))
+        properties = {cv2.CAP_PROP_FPS: fps}
 
         if resolution == "full":
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH , constants.CAMERA_RESOLUTION[1])
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, constants.CAMERA_RESOLUTION[0])
+            properties[cv2.CAP_PROP_FRAME_WIDTH ] = constants.CAMERA_RESOLUTION[1]
+            properties[cv2.CAP_PROP_FRAME_HEIGHT] = constants.CAMERA_RESOLUTION[0]
         if resolution == "low":
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH , constants.DISPLAY_RESOLUTION[1])
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, constants.DISPLAY_RESOLUTION[0])
-
+            properties[cv2.CAP_PROP_FRAME_WIDTH ] = constants.DISPLAY_RESOLUTION[1]
+            properties[cv2.CAP_PROP_FRAME_HEIGHT] = constants.DISPLAY_RESOLUTION[0]
+        # switching resolution (low/full, streaming mode) restarts the stream, the driver may reset other properties
+        # and controls meanwhile. all values are sent again
+        if any(self.cameraControl.properties.get(prop) != properties[prop] for prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT) if prop in properties):
+            self.cameraControl.invalidate()
+        changed = self.cameraControl.setProperties(properties)
+
+        #set white balance
+        controls = {"white_balance_auto_preset" : 0,
+                    "red_balance"               : constants.RED_GAIN,
+                    "blue_balance"              : constants.BLUE_GAIN,
+                    "exposure_dynamic_framerate": 1,
+                    "iso_sensitivity_auto"      : 0}
+        #set exposure
+        if exposureTime == 0: # exposureTime==0 -> auto
+            controls["auto_exposure"] = 0
+        else:
+            controls["auto_exposure"] = 1
+            controls["exposure_time_absolute"] = max(1, int(round(exposureTime)))
+        changed += self.cameraControl.setControls(controls)
 
-        if not testMode:
-            #set white balance
-            subprocess.check_call(f"v4l2-ctl -d /dev/video0 -c white_balance_auto_preset=0 -c red_balance={constants.RED_GAIN} -c blue_balance={constants.BLUE_GAIN} -c exposure_dynamic_framerate=1 -c iso_sensitivity_auto=0 ", shell = True)
-            #set exposure
-            if constants.settings[LEDMmode]["exposureTime"] == 0: # exposureTime==0 -> auto
-                subprocess.check_call("v4l2-ctl -d /dev/video0 -c white_balance_auto_preset=0 -c auto_exposure=0", shell = True)
-            else:
-                subprocess.check_call(f"v4l2-ctl -d /dev/video0 -c auto_exposure=1 -c exposure_time_absolute={constants.settings[LEDMmode]['exposureTime']}", shell = True)
\ No newline at end of file
+        logger.info(f"Capture settings: {len(changed)} changed ({(time.perf_counter() - startTime) * 1000:.1f} ms)")
@@ -0,0 +1,174 @@
+"""Encode and write images to disk in a background thread."""
+import io
+import os
+import json
+import time
+import queue as Queue
+import threading
+from datetime import datetime
+import numpy as np
+import cv2
+
+import constants
+from logger import logger
+from runArchive import RunArchive
+from profiling import stage, timed
+
+
+EXTENSIONS = {"tiff": ".tiff", "png": ".png", "npz": ".npz", "npy": ".npy", "hdf5": ".h5"}
+ARCHIVE_SEPARATOR = ":" # frame in run archive is referred to as <archive file>:<frame name>
+
+# libtiff compression codes (cv2.IMWRITE_TIFF_COMPRESSION_* is missing in older cv2 versions)
+TIFF_COMPRESSION = {
+    "none"   : 1,
+    "lzw"    : 5,
+    "deflate": 8,
+    "zstd"   : 50000, # only if libtiff of cv2 is built with zstd
+}
+
+
+def saveFormatSettings():
+    """Return save settings from constants.settings. Missing values are taken from constants.SAVE_DEFAULTS."""
+    return {**constants.SAVE_DEFAULTS, **constants.settings.get("Save", {})}
+
+
+@timed("saveImage.encode")
+def encodeImage(image, options = None):
+    """Encode RGB image in memory.
+    :param np.ndarray image: RGB image
+    :param dict options: save settings, default saveFormatSettings()
+    :return tuple: encoded bytes (buffer), file ending"""
+    options = {**saveFormatSettings(), **(options or {})}
+    fileFormat = options["format"]
+    if fileFormat in ("npz", "npy"):
+        buffer = io.BytesIO()
+        if fileFormat == "npz": np.savez_compressed(buffer, image = image)
+        else:                   np.save(buffer, image)
+        return buffer.getbuffer(), EXTENSIONS[fileFormat]
+
+    if   fileFormat == "tiff": params = [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION[options["tiffCompression"]]]
+    elif fileFormat == "png":  params = [cv2.IMWRITE_PNG_COMPRESSION , int(options["pngCompression"])]
+    else: raise ValueError(f"Unknown image format {fileFormat}")
+    try:
+        success, buffer = cv2.imencode(EXTENSIONS[fileFormat], cv2.cvtColor(image, cv2.COLOR_RGB2BGR), params)
+    except cv2.error:
+        success = False
+    if not success:
+        raise IOError(f"Could not encode image as {fileFormat} ({options})")
+    return buffer, EXTENSIONS[fileFormat]
+
+
+def writeImage(path, image, options = None):
+    """Encode RGB image and write it to path + file ending of format.
+    :param str path: file name without ending
+    :param np.ndarray image: RGB image
+    :param dict options: save settings, default saveFormatSettings()
+    :return str: file name written"""
+    buffer, ending = encodeImage(image, options)
+    with stage("saveImage.write"), open(path + ending, "wb") as file:
+        file.write(buffer)
+    return path + ending
+
+
+def writeSidecar(path, data):
+    """Write data as json to path + '.json'. Used for cell centroids and settings instead of an annotated image.
+    :return str: file name written"""
+    with open(path + ".json", "w") as file:
+        json.dump(data, file, indent = 4)
+    return path + ".json"
+
+
+def readImage(path):
+    """Read image written by writeImage (or cv2.imwrite of BGR image) or frame of run archive (<file>.h5:<frame name>).
+    :return np.ndarray: RGB image"""
+    if EXTENSIONS["hdf5"] + ARCHIVE_SEPARATOR in path:
+        archivePath, name = path.rsplit(ARCHIVE_SEPARATOR, 1)
+        with RunArchive(archivePath, "r") as archive:
+            return archive.readFrame(name)
+    if path.endswith((".npz", ".npy")):
+        data = np.load(path)
+        return data["image"] if path.endswith(".npz") else data
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError(f"Could not read image {path}")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ImageWriter():
+    """Queue of images encoded and written one after another by a worker thread, so capturing does not wait for slow USB writes.
+    onDone(path, seconds) and onFailed(path, message) are called from the worker thread.
+    With format "hdf5" images are appended to the run archive <directory>/<runName>.h5 instead of written to single files."""
+    def __init__(self, onDone = None, onFailed = None, runName = None):
+        self.onDone   = onDone
+        self.onFailed = onFailed
+        self.runName  = runName or "run_" + datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
+        self.archive  = None # RunArchive, only used by worker thread
+        self.queue  = Queue.Queue()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, path, image, sidecar = None, options = None, onQueued = None):
+        """Queue image for writing. image must not be modified afterwards.
+        :param str path: file name without ending
+        :param np.ndarray image: RGB image
+        :param dict sidecar: json serializable data written to path + '.json' (attributes in run archive)
+        :param dict options: save settings, default saveFormatSettings() at time of submit
+        :param callable onQueued: called with file name of image before it is queued, so it runs before onDone/onFailed
+        :return str: file name of image"""
+        options = {**saveFormatSettings(), **(options or {})}
+        fileName = self._fileName(path, options)
+        if onQueued is not None: onQueued(fileName)
+        self.queue.put((path, image, sidecar, options))
+        return fileName
+
+    def _fileName(self, path, options):
+        if options["format"] == "hdf5":
+            return os.path.join(os.path.dirname(path), self.runName + EXTENSIONS["hdf5"]) + ARCHIVE_SEPARATOR + os.path.basename(path)
+        return path + EXTENSIONS[options["format"]]
+
+    @timed("saveImage.archive")
+    def _appendToArchive(self, path, image, sidecar, options):
+        archivePath = os.path.join(os.path.dirname(path), self.runName + EXTENSIONS["hdf5"])
+        if self.archive is None or self.archive.path != archivePath:
+            if self.archive is not None: self.archive.close()
+            self.archive = RunArchive(archivePath)
+        self.archive.appendFrame(os.path.basename(path), image, sidecar, options["archiveCompression"])
+
+    def pending(self):
+        """:return int: number of images not written yet"""
+        return self.queue.unfinished_tasks
+
+    def join(self):
+        """Block until all queued images are written."""
+        self.queue.join()
+
+    def close(self):
+        """Write queued images and stop worker thread."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            path, image, sidecar, options = job
+            fileName = self._fileName(path, options)
+            try:
+                startTime = time.perf_counter()
+                if options["format"] == "hdf5":
+                    self._appendToArchive(path, image, sidecar, options)
+                else:
+                    writeImage(path, image, options)
+                    if sidecar is not None:
+                        writeSidecar(path, sidecar)
+                if self.onDone is not None: self.onDone(fileName, time.perf_counter() - startTime)
+            except Exception as e: # pylint: disable=broad-except
+                logger.warn(f"Writing {fileName} failed: {e}")
+                if self.onFailed is not None: self.onFailed(fileName, str(e))
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,56 @@
+"""Approximate counting of live preview frames in a worker thread."""
+import time
+import threading
+import numpy as np
+
+import constants
+from logger import logger
+from count import getCellsApproximate, countingSettings, scaleParams
+
+
+class LiveCounter():
+    """Counts every interval-th submitted frame with count.getCellsApproximate in a worker thread.
+    Frames are skipped while the worker is busy, so submitting never blocks the preview.
+    onResult(cells, seconds) is called from the worker thread."""
+    def __init__(self, onResult, shape = constants.DISPLAY_RESOLUTION + (3,), interval = 5):
+        """:param tuple shape: shape of frames
+        :param int interval: count every interval-th frame"""
+        self.onResult = onResult
+        self.interval = interval
+        self.frameNumber = 0
+        self._frame = np.empty(shape, dtype = np.uint8) # copy of frame being counted
+        self._busy = False
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def submit(self, frame):
+        """Count frame if it is the interval-th frame and the worker is idle.
+        :param np.ndarray frame: RGB frame, copied
+        :return bool: frame was accepted"""
+        self.frameNumber += 1
+        if self.frameNumber % self.interval:
+            return False
+        with self._condition:
+            if self._busy:
+                return False
+            np.copyto(self._frame, frame)
+            self._busy = True
+            self._condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._busy)
+            startTime = time.perf_counter()
+            try:
+                # counting parameters are tuned for full resolution
+                params = scaleParams(countingSettings(), constants.CAMERA_RESOLUTION[0] / self._frame.shape[0])
+                cells = getCellsApproximate(self._frame, params)
+                self.onResult(cells, time.perf_counter() - startTime)
+            except Exception as e: # pylint: disable=broad-except
+                logger.warn(f"Live count failed: {e}")
+            finally:
+                with self._condition:
+                    self._busy = False
@@ -0,0 +1,31 @@
+"""Peak memory (resident set size) of this process.
+The peak is kept per process, not per thread: it is only the peak of one computation if nothing else runs in the
+process meanwhile (e.g. a batchCount worker counting one image at a time). In the gui, precount, live count, counting
+preview and image writer threads add to it, and a reset by one counting also resets the peak of a concurrent one."""
+import resource
+import sys
+
+
+def resetPeakRSS():
+    """Reset peak RSS of the whole process to current RSS. Only possible on linux, no-op otherwise.
+    :return bool: True if reset was successful"""
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peakRSS():
+    """Peak RSS of the whole process (all threads) since start of process or last resetPeakRSS call in MB."""
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on linux, in bytes on mac
+    maxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRSS / 1024**2 if sys.platform == "darwin" else maxRSS / 1024
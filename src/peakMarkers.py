@@ -0,0 +1,128 @@
+"""Watershed markers from local maxima in one pass over the pixels of a mask.
+Compiled with numba if it is installed (optional), cv2/numpy otherwise."""
+import numpy as np
+import cv2
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def findMarkersMasked(data, mask, minDistance, threshold = None):
+    """Markers for watershed: 4-connected groups of local maxima of data inside of mask. A local maximum is the
+    maximum of its (2*minDistance+1)^2 window, above threshold and not within minDistance of the border, like the
+    coordinates of peak_local_max(data, min_distance=minDistance). Markers are numbered in raster order.
+    peak_local_max keeps only one pixel of a plateau, here the plateau is one marker, so the segmentation is the same.
+    :param np.ndarray data: float image
+    :param np.ndarray mask: boolean image, only maxima inside are found
+    :param float threshold: default minimum of data
+    :return np.ndarray: int32 markers, 0 is background"""
+    if threshold is None:
+        threshold = np.min(data)
+    if _markersKernel is not None:
+        # contiguous arrays only, every other layout would be compiled again
+        return _markersKernel(np.ascontiguousarray(data), np.ascontiguousarray(mask).view(np.uint8), minDistance, threshold)
+    return _markersFallback(data, mask, minDistance, threshold)
+
+
+def warmUp():
+    """Compile (or load from numba's cache) the kernel for float32 and float64 data, so the first count does not
+    wait for it. Takes about 1.5 s without cache, called at startup."""
+    if _markersKernel is None:
+        return
+    for dtype in (np.float32, np.float64):
+        findMarkersMasked(np.zeros((8, 8), dtype = dtype), np.ones((8, 8), dtype = bool), 1)
+
+
+def _markersFallback(data, mask, minDistance, threshold):
+    """Maximum filter of the whole image by dilation, restricted to mask afterwards."""
+    size = 2*minDistance + 1
+    peaks = data == cv2.dilate(data, cv2.getStructuringElement(cv2.MORPH_RECT, (size, size)))
+    peaks &= mask
+    peaks &= data > threshold
+    peaks[:minDistance] = peaks[-minDistance:] = False
+    peaks[:,:minDistance] = peaks[:,-minDistance:] = False
+    return cv2.connectedComponents(peaks.view(np.uint8), connectivity = 4, ltype = cv2.CV_32S)[1]
+
+
+def _markersNumba(data, mask, minDistance, threshold):
+    """Only pixels of mask are tested. Pixels lower than one of their 8 neighbours are rejected before the window
+    is scanned, which leaves only maxima and plateaus. Maxima are labelled while scanning (union find of the
+    upper and left neighbour), so the image is only passed once."""
+    rows, cols = data.shape
+    markers = np.zeros((rows, cols), dtype = np.int32)
+    parent  = np.zeros(64, dtype = np.int32) # union find of provisional labels
+    peakRows = np.zeros(64, dtype = np.int64)
+    peakCols = np.zeros(64, dtype = np.int64)
+    numPeaks = 0
+    numLabels = 0
+    for row in range(minDistance, rows - minDistance):
+        for col in range(minDistance, cols - minDistance):
+            if mask[row, col] == 0:
+                continue
+            value = data[row, col]
+            if value <= threshold:
+                continue
+            isMaximum = True
+            for r in range(row - 1, row + 2):
+                for c in range(col - 1, col + 2):
+                    if data[r, c] > value:
+                        isMaximum = False
+            if not isMaximum:
+                continue
+            for r in range(row - minDistance, row + minDistance + 1):
+                for c in range(col - minDistance, col + minDistance + 1):
+                    if data[r, c] > value:
+                        isMaximum = False
+                        break
+                if not isMaximum:
+                    break
+            if not isMaximum:
+                continue
+
+            up   = markers[row - 1, col]
+            left = markers[row, col - 1]
+            if up == 0 and left == 0:
+                numLabels += 1
+                if numLabels >= len(parent):
+                    parent = np.concatenate((parent, np.zeros(len(parent), dtype = np.int32)))
+                parent[numLabels] = numLabels
+                label = numLabels
+            else:
+                label = max(up, left)
+                while parent[label] != label:
+                    label = parent[label]
+                if up != 0 and left != 0:
+                    other = min(up, left)
+                    while parent[other] != other:
+                        other = parent[other]
+                    if other < label:
+                        parent[label] = other
+                        label = other
+                    elif label < other:
+                        parent[other] = label
+            markers[row, col] = label
+
+            if numPeaks >= len(peakRows):
+                peakRows = np.concatenate((peakRows, np.zeros(len(peakRows), dtype = np.int64)))
+                peakCols = np.concatenate((peakCols, np.zeros(len(peakCols), dtype = np.int64)))
+            peakRows[numPeaks] = row
+            peakCols[numPeaks] = col
+            numPeaks += 1
+
+    # final labels numbered consecutively in raster order of their first pixel
+    final = np.zeros(numLabels + 1, dtype = np.int32)
+    nextLabel = 0
+    for i in range(numPeaks):
+        label = markers[peakRows[i], peakCols[i]]
+        while parent[label] != label:
+            label = parent[label]
+        if final[label] == 0:
+            nextLabel += 1
+            final[label] = nextLabel
+        markers[peakRows[i], peakCols[i]] = final[label]
+    return markers
+
+
+_markersKernel = numba.njit(cache = True, nogil = True)(_markersNumba) if numba is not None else None
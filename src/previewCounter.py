@@ -0,0 +1,66 @@
+"""Counting settings preview on a downscaled full image in a worker thread."""
+import time
+import threading
+import cv2
+
+import constants
+from logger import logger
+from count import findDishCircle, countingSettings, scaleParams
+from countingSession import CountingSession
+
+
+class PreviewCounter():
+    """Counts a downscaled copy of the full image with a CountingSession in a worker thread, so moving a counting
+    slider never blocks the gui. Only the last submitted parameters are counted, earlier requests are dropped.
+    onResult(image, cells, seconds) is called from the worker thread with the full image the cells belong to."""
+    def __init__(self, onResult, reduceFactor = constants.PREVIEW_REDUCE_FACTOR):
+        """:param int reduceFactor: downscaling of full image"""
+        self.onResult = onResult
+        self.reduceFactor = reduceFactor
+        self._image   = None # full image of session
+        self._session = None
+        self._nextImage  = None # full image to prepare session for
+        self._nextParams = None # counting parameters to count with
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def setImage(self, image):
+        """Downscale image and detect its dish circle in the worker. Done once per image, not for every count.
+        :param np.ndarray image: RGB full image, must not be modified"""
+        with self._condition:
+            if image is self._image or image is self._nextImage:
+                return
+            self._nextImage = image
+            self._condition.notify()
+
+    def submit(self, image, params = None):
+        """Count image with params (default countingSettings()) in the worker, replacing a request not started yet.
+        :param dict params: counting parameters for full image"""
+        self.setImage(image)
+        with self._condition:
+            self._nextParams = dict(params or countingSettings())
+            self._condition.notify()
+
+    def _prepare(self, image):
+        reduceFactor = self.reduceFactor
+        downscaled = cv2.resize(image, (image.shape[1] // reduceFactor, image.shape[0] // reduceFactor), interpolation = cv2.INTER_AREA)
+        self._session = CountingSession(downscaled, circle = findDishCircle(image) / reduceFactor)
+        self._image   = image
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._nextImage is not None or self._nextParams is not None)
+                image, self._nextImage   = self._nextImage, None
+                params, self._nextParams = self._nextParams, None
+            startTime = time.perf_counter()
+            try:
+                if image is not None:
+                    self._prepare(image)
+                if params is None or self._session is None:
+                    continue
+                cells = self._session.count(scaleParams(params, self.reduceFactor))
+                self.onResult(self._image, [(x * self.reduceFactor, y * self.reduceFactor) for x, y in cells], time.perf_counter() - startTime)
+            except Exception as e: # pylint: disable=broad-except
+                logger.warn(f"Counting preview failed: {e}")
@@ -0,0 +1,91 @@
+"""Timers for stages of counting, capturing and saving (settings["Profiling"]).
+Disabled timers are a shared no-op context manager."""
+import time
+import functools
+import threading
+from collections import deque
+from contextlib import nullcontext
+
+import constants
+from logger import logger
+
+
+_NULL_TIMER = nullcontext()
+
+
+def profilingSettings():
+    """Return profiling settings from constants.settings. Missing values are taken from constants.PROFILING_DEFAULTS."""
+    return {**constants.PROFILING_DEFAULTS, **constants.settings.get("Profiling", {})}
+
+
+class StageTimer():
+    """Context manager measuring one stage and passing it to profiler."""
+    __slots__ = ("profiler", "name", "startTime")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name, time.perf_counter() - self.startTime)
+        return False
+
+
+class Profiler():
+    """Collects stage timings in rolling buffers, logs them and passes them to listeners."""
+    def __init__(self, bufferLength = 100):
+        self.enabled = False
+        self.bufferLength = bufferLength
+        self.timings = {} # stage name: deque of seconds
+        self.listeners = [] # called with stage name and seconds, from thread the stage ran in
+        self._lock = threading.Lock()
+
+    def configure(self):
+        """Enable/disable by settings["Profiling"]["enabled"]."""
+        self.enabled = profilingSettings()["enabled"]
+
+    def stage(self, name):
+        """Context manager timing the code inside.
+        :param str name: stage name, e.g. 'count.watershed'"""
+        if not self.enabled:
+            return _NULL_TIMER
+        return StageTimer(self, name)
+
+    def record(self, name, seconds):
+        with self._lock:
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen = self.bufferLength)
+            self.timings[name].append(seconds)
+        logger.info(f"Stage {name}: {seconds * 1000:.1f} ms")
+        for listener in self.listeners:
+            listener(name, seconds)
+
+    def summary(self):
+        """Statistics of buffered timings.
+        :return dict: stage name: dict with number of timings, last, mean and max seconds"""
+        with self._lock:
+            return {name: {"n": len(values), "last": values[-1], "mean": sum(values) / len(values), "max": max(values)}
+                    for name, values in self.timings.items() if values}
+
+    def clear(self):
+        with self._lock:
+            self.timings.clear()
+
+
+profiler = Profiler()
+stage = profiler.stage
+
+
+def timed(name):
+    """Decorator timing every call of the function as stage name."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,164 @@
+"""Persistent cache of counting results, keyed by image content, counting parameters and code version.
+Counting an image again with the same parameters (reopened capture, rerun of batch counting) returns immediately."""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+import constants
+from logger import logger
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+# counting parameters which do not change the result of getCells
+IGNORED_PARAMS = ("precount", "liveCount", "liveInterval", "countPairs")
+
+# result changes if one of these files changes
+CODE_FILES = ("count.py", "peakMarkers.py")
+
+
+def cacheSettings():
+    """Return result cache settings from constants.settings. Missing values are taken from constants.RESULT_CACHE_DEFAULTS."""
+    return {**constants.RESULT_CACHE_DEFAULTS, **constants.settings.get("ResultCache", {})}
+
+
+def imageHash(image):
+    """Digest of shape, dtype and all pixels of image. xxh3 if xxhash is installed (optional), blake2b otherwise.
+    :param np.ndarray image: any image
+    :return str: hex digest"""
+    digest = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size = 16)
+    digest.update(f"{image.shape}{image.dtype}".encode())
+    digest.update(memoryview(image if image.flags.c_contiguous else image.copy()).cast("B"))
+    return digest.hexdigest()
+
+
+def paramsHash(params):
+    """:param dict params: counting parameters, IGNORED_PARAMS are left out
+    :return str: hex digest"""
+    params = {key: value for key, value in params.items() if key not in IGNORED_PARAMS}
+    return hashlib.blake2b(json.dumps(params, sort_keys = True, default = str).encode(), digest_size = 16).hexdigest()
+
+
+_codeVersion = None
+def codeVersion():
+    """Digest of CODE_FILES, computed once."""
+    global _codeVersion # pylint: disable=global-statement
+    if _codeVersion is None:
+        digest = hashlib.blake2b(digest_size = 8)
+        for fileName in CODE_FILES:
+            digest.update(Path(__file__).with_name(fileName).read_bytes())
+        _codeVersion = digest.hexdigest()
+    return _codeVersion
+
+
+class ResultCache():
+    """SQLite file mapping keys to json serialized results. Least recently used results are removed if the results
+    take more than maxBytes. Thread safe, several processes can share the file."""
+    def __init__(self, path, maxBytes):
+        """:param str path: database file, created if missing
+        :param int maxBytes: maximal size of all results"""
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout = 10, check_same_thread = False)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL, "
+                                    "size INTEGER NOT NULL, lastUsed REAL NOT NULL)")
+
+    @staticmethod
+    def key(images, params):
+        """:param tuple images: images the result depends on
+        :param dict params: counting parameters
+        :return str: key of result"""
+        return "-".join([imageHash(image) for image in images] + [paramsHash(params), codeVersion()])
+
+    def get(self, key):
+        """:return: result stored under key or None"""
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE results SET lastUsed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """Store json serializable result under key and evict least recently used results."""
+        data = json.dumps(result)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, data, len(data), time.time()))
+            self._evict()
+
+    def _evict(self):
+        excess = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0] - self.maxBytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY lastUsed"):
+            if excess <= 0:
+                break
+            keys.append((key,))
+            excess -= size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", keys)
+
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM results")
+
+    def close(self):
+        self.connection.close()
+
+
+_cache = None
+_cacheOwner = None # pid, path and size the cache was opened with
+def resultCache():
+    """Cache of this process configured by cacheSettings(), opened on first use.
+    :return ResultCache: None if disabled or the file can not be opened"""
+    global _cache, _cacheOwner # pylint: disable=global-statement
+    settings = cacheSettings()
+    if not settings["enabled"]:
+        return None
+    path = os.path.join(str(Path(__file__).parent.absolute()), "../resources", settings["path"])
+    owner = (os.getpid(), path, int(settings["maxMB"] * 1e6))
+    # connections must not be shared with forked worker processes
+    if _cache is None or _cacheOwner != owner:
+        try:
+            _cache = ResultCache(path, owner[2])
+        except sqlite3.Error as e:
+            logger.warn(f"Result cache {path} not available: {e}")
+            return None
+        _cacheOwner = owner
+    return _cache
+
+
+def cached(images, params, compute):
+    """Return result of compute() from the result cache if images were counted with params before.
+    Counting works without cache if it is disabled or not readable.
+    :param tuple images: images the result depends on
+    :param dict params: counting parameters
+    :param callable compute: returns json serializable result, stored in cache
+    :return tuple: result, True if it was taken from the cache"""
+    cache = resultCache()
+    if cache is None:
+        return compute(), False
+    try:
+        key = cache.key(images, params)
+        result = cache.get(key)
+    except sqlite3.Error as e:
+        logger.warn(f"Result cache not readable: {e}")
+        return compute(), False
+    if result is not None:
+        return result, True
+
+    result = compute()
+    try:
+        cache.put(key, result)
+    except sqlite3.Error as e:
+        logger.warn(f"Result cache not writable: {e}")
+    return result, False
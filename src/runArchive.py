@@ -0,0 +1,102 @@
+"""HDF5 archive of all captures of a run. Needs h5py, which is optional."""
+import json
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+CHUNK_SHAPE = (256, 256, 3)
+
+# archive compression setting: h5py compression, options
+COMPRESSION = {
+    "none": (None  , None),  # contiguous, can be memory mapped
+    "lzf" : ("lzf" , None),  # fast, ships with h5py
+    "gzip": ("gzip", 1   ),
+}
+
+
+class RunArchive():
+    """Captured frames stored as chunked compressed datasets /captures/<name>/image, with attributes
+    (settings, mode, ...) and the cells found in /captures/<name>/cells.
+    Frames and regions of frames are read without decoding the whole file."""
+    def __init__(self, path, mode = "a"):
+        """:param str path: .h5 file
+        :param str mode: h5py file mode, "r" to read only"""
+        if h5py is None:
+            raise ImportError("h5py is needed for run archives (pip install h5py)")
+        self.path = path
+        self.file = h5py.File(path, mode)
+
+    def appendFrame(self, name, image, attributes = None, compression = "lzf"):
+        """Add frame. Existing frame with same name is replaced.
+        :param str name: frame name, e.g. file name without ending
+        :param np.ndarray image: RGB image
+        :param dict attributes: json serializable. "cells" (n, 2) is stored as dataset, other values as attributes
+        :param str compression: key of COMPRESSION"""
+        captures = self.file.require_group("captures")
+        if name in captures:
+            del captures[name]
+        group = captures.create_group(name)
+
+        compression, compressionOpts = COMPRESSION[compression]
+        chunks = tuple(min(c, s) for c, s in zip(CHUNK_SHAPE, image.shape)) if compression is not None else None
+        group.create_dataset("image", data = image, chunks = chunks, compression = compression, compression_opts = compressionOpts)
+
+        for key, value in (attributes or {}).items():
+            if key == "cells":
+                self.setCells(name, value)
+            else:
+                group.attrs[key] = json.dumps(value)
+        self.file.flush()
+
+    def setCells(self, name, cells):
+        """Store cells found in frame.
+        :param list cells: (x, y)"""
+        group = self.file["captures"][name]
+        if "cells" in group:
+            del group["cells"]
+        group.create_dataset("cells", data = np.asarray(cells, dtype = np.int32).reshape(-1, 2))
+
+    def frames(self):
+        """:return list: names of all frames"""
+        return list(self.file["captures"]) if "captures" in self.file else []
+
+    def memmapFrame(self, name):
+        """Frame as read only memory map, without reading it.
+        :return np.memmap: None if frame is compressed or chunked"""
+        dataset = self.file["captures"][name]["image"]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is not None or offset is None:
+            return None
+        return np.memmap(self.path, mode = "r", dtype = dataset.dtype, shape = dataset.shape, offset = offset)
+
+    def readFrame(self, name, region = None):
+        """Read frame or part of it. Only chunks in region are decompressed, uncompressed frames are memory mapped.
+        :param tuple region: (rows, columns) slices, default whole frame
+        :return np.ndarray: RGB image"""
+        region = region or (slice(None), slice(None))
+        frame = self.memmapFrame(name)
+        if frame is not None:
+            return np.array(frame[region])
+        return self.file["captures"][name]["image"][region]
+
+    def readCells(self, name):
+        """:return np.ndarray: (n, 2) cells as (x, y), None if frame was not counted"""
+        group = self.file["captures"][name]
+        return group["cells"][()] if "cells" in group else None
+
+    def attributes(self, name):
+        """:return dict: attributes stored with frame"""
+        return {key: json.loads(value) for key, value in self.file["captures"][name].attrs.items()}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()